@@ -1,13 +1,239 @@
 import collections
+import inspect
 import logging
 import os
 import hashlib
 import zlib
 import pickle
+import random
+import re
 import time
 
 logger = logging.getLogger(__name__)
 
+_kwd_mark = (object(),)
+_fast_types = {int, str}
+
+
+class _HashedKey(list):
+    """Key that only calculates the hash of its tuple once (like functools' _HashedSeq)"""
+    __slots__ = ('hashvalue',)
+
+    def __init__(self, key):
+        self[:] = key
+        self.hashvalue = hash(key)
+
+    def __hash__(self):
+        return self.hashvalue
+
+
+def _encode(obj, write):
+    """
+    Write a canonical, type-tagged byte encoding of obj, ``write`` gets called
+    with each part.
+    """
+    t = type(obj)
+    if obj is None:
+        write(b'N')
+    elif t is bool:
+        write(b'T' if obj else b'F')
+    elif t is int:
+        data = b'%d' % (obj,)
+        write(b'i%d:' % (len(data),))
+        write(data)
+    elif t is float:
+        data = repr(obj).encode('ascii')
+        write(b'f%d:' % (len(data),))
+        write(data)
+    elif t is str:
+        data = obj.encode('utf-8', 'surrogatepass')
+        write(b's%d:' % (len(data),))
+        write(data)
+    elif t is bytes:
+        write(b'b%d:' % (len(obj),))
+        write(obj)
+    elif t is tuple or t is list:
+        write(b'%s%d:' % (b't' if t is tuple else b'l', len(obj)))
+        for item in obj:
+            _encode(item, write)
+    elif t is dict:
+        write(b'd%d:' % (len(obj),))
+        for k, v in sorted((_encoded(k), _encoded(v)) for k, v in obj.items()):
+            write(k)
+            write(v)
+    elif t is set or t is frozenset:
+        write(b'S%d:' % (len(obj),))
+        for item in sorted(map(_encoded, obj)):
+            write(item)
+    else:
+        # unknown types (or subclasses) are tagged by their full type name
+        name = ('%s.%s' % (t.__module__, t.__qualname__)).encode('utf-8')
+        write(b'o%d:' % (len(name),))
+        write(name)
+        if isinstance(obj, (int, float, str, bytes, tuple, list, dict, set, frozenset)):
+            base = next(base for base in t.__mro__ if base in _encodable_types)
+            _encode(base(obj), write)
+        else:
+            _encode(repr(obj), write)
+
+
+_encodable_types = (int, float, str, bytes, tuple, list, dict, set, frozenset)
+
+
+def _encoded(obj):
+    parts = []
+    _encode(obj, parts.append)
+    return b''.join(parts)
+
+
+def digest_key(*args, **kwargs):
+    """
+    Stable digest of the given arguments, usable as key for persistent caches.
+
+    Arguments are canonically encoded including their type, so ``'1'``,
+    ``1`` and ``1.0`` or ``'a|b'`` and ``('a', 'b')`` all result in different
+    keys. Objects of other types are encoded by their ``repr()``, which should
+    thus be stable for them.
+
+    >>> digest_key('a|b') == digest_key('a', 'b')
+    False
+    >>> digest_key(1) == digest_key('1')
+    False
+    >>> digest_key(a=1, b=2) == digest_key(b=2, a=1)
+    True
+    >>> digest_key({'x': [1, 2]}, y={3})
+    '421e1822e9bd4c909c923103774298d4'
+
+    :rtype: str
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    write = hasher.update
+    _encode(args, write)
+    if kwargs:
+        _encode(kwargs, write)
+    return hasher.hexdigest()
+
+
+def uses_hashable_keys(cacher):
+    """
+    Whether the cacher accepts any hashable object (e.g. a tuple) as key, and
+    doesn't need a (digested) string key.
+
+    >>> uses_hashable_keys(LocalCacher())
+    True
+    >>> uses_hashable_keys({})
+    True
+    >>> uses_hashable_keys(FileCacher.__new__(FileCacher))
+    False
+    """
+    return isinstance(cacher, dict) or getattr(cacher, 'hashable_keys', False)
+
+
+class CacheKey:
+    """
+    Builds cache keys for function calls.
+
+    Calling the instance gives a hashable tuple key, usable for in-memory
+    caches, :meth:`digest` gives a stable string digest usable for persistent
+    caches (see :func:`digest_key`).
+
+    >>> def func(a, b=None, session=None):
+    ...     pass
+    >>> key = CacheKey(func)
+    >>> key(1, b=2) == key(1, b=2)
+    True
+    >>> key('a|b') == key('a', 'b')
+    False
+    >>> key('a')
+    'a'
+    >>> key([1, 2]) == key([1, 2])
+    True
+    >>> key = CacheKey(func, ignore=['session'], key_funcs={'b': str.lower})
+    >>> key(1, 'B', session=object()) == key(1, 'b')
+    True
+    >>> key.digest(1, 'B', session=object()) == key.digest(1, 'b')
+    True
+    >>> key = CacheKey(typed=True)
+    >>> key(1) == key(1.0)
+    False
+    >>> CacheKey(prefix=('name',))(1)
+    ['name', 1]
+
+    :param callable func: the function, used to resolve argument names
+    :param bool typed: whether arguments of different types are cached separately
+    :param dict key_funcs: mapping of argument names (or positions) to functions
+        that return the value to use in the key
+    :param list ignore: names (or positions) of arguments to ignore
+    :param tuple prefix: values to prepend to each key
+    """
+
+    def __init__(self, func=None, typed=False, key_funcs=None, ignore=None, prefix=None):
+        self.typed = typed
+        self.prefix = tuple(prefix) if prefix else ()
+        self.key_funcs = {}
+        self.ignore = set()
+        positions = self._positions(func) if key_funcs or ignore else {}
+
+        for name, key_func in (key_funcs or {}).items():
+            self.key_funcs[name] = key_func
+            if name in positions:
+                self.key_funcs[positions[name]] = key_func
+
+        for name in ignore or ():
+            self.ignore.add(name)
+            if name in positions:
+                self.ignore.add(positions[name])
+
+        self._simple = not (self.typed or self.key_funcs or self.ignore)
+
+    @staticmethod
+    def _positions(func):
+        if func is None:
+            return {}
+        try:
+            parameters = inspect.signature(func).parameters.values()
+        except (TypeError, ValueError):
+            return {}
+        positional = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+        return {param.name: idx for idx, param in enumerate(parameters) if param.kind in positional}
+
+    def _transform(self, args, kwargs):
+        key_funcs = self.key_funcs
+        ignore = self.ignore
+        args = tuple(key_funcs[idx](arg) if idx in key_funcs else arg
+                     for idx, arg in enumerate(args) if idx not in ignore)
+        kwargs = {k: key_funcs[k](v) if k in key_funcs else v
+                  for k, v in kwargs.items() if k not in ignore}
+        return args, kwargs
+
+    def __call__(self, *args, **kwargs):
+        if self._simple:
+            if not kwargs and not self.prefix and len(args) == 1 and type(args[0]) in _fast_types:
+                return args[0]
+        else:
+            args, kwargs = self._transform(args, kwargs)
+
+        key = self.prefix + args
+        if kwargs:
+            key += _kwd_mark
+            for item in sorted(kwargs.items()):
+                key += item
+        if self.typed:
+            key += tuple(type(v) for v in args)
+            if kwargs:
+                key += tuple(type(v) for k, v in sorted(kwargs.items()))
+
+        try:
+            return _HashedKey(key)
+        except TypeError:
+            # unhashable arguments, fall back to a digest of the (already transformed) arguments
+            return digest_key(*self.prefix, *args, **kwargs)
+
+    def digest(self, *args, **kwargs):
+        if not self._simple:
+            args, kwargs = self._transform(args, kwargs)
+        return digest_key(*self.prefix, *args, **kwargs)
+
 
 class DictCacher(dict):
     """
@@ -31,7 +257,7 @@ class DictCacher(dict):
     >>> 'test' in cache
     True
     """
-    pass
+    hashable_keys = True
 
 
 class WrapperCacher:
@@ -56,6 +282,12 @@ class WrapperCacher:
     def __contains__(self, k):
         return k in self.obj
 
+    def __delitem__(self, k):
+        return self.obj.delete(k)
+
+    def clear(self):
+        return self.obj.clear()
+
 
 class LocalCacher:
     """
@@ -84,6 +316,8 @@ class LocalCacher:
     ...
     KeyError: 'test'
     """
+    hashable_keys = True
+
     def __init__(self, max_items=None):
         self.dict = collections.OrderedDict()
         self.max_items = max_items
@@ -91,13 +325,22 @@ class LocalCacher:
     def __setitem__(self, k, v):
         if self.max_items is not None and len(self.dict) >= self.max_items:
             self.dict.popitem(last=False)
-        self.dict[str(k)] = v
+        self.dict[k] = v
 
     def __getitem__(self, k):
-        return self.dict[str(k)]
+        return self.dict[k]
 
     def __contains__(self, k):
-        return str(k) in self.dict
+        return k in self.dict
+
+    def __delitem__(self, k):
+        del self.dict[k]
+
+    def __len__(self):
+        return len(self.dict)
+
+    def clear(self):
+        self.dict.clear()
 
 
 class DummyCacher:
@@ -114,6 +357,8 @@ class DummyCacher:
     >>> 'test2' in cache
     False
     """
+    hashable_keys = True
+
     @staticmethod
     def __getitem__(i):
         raise KeyError(i)
@@ -126,11 +371,99 @@ class DummyCacher:
     def __contains__(k):
         return False
 
+    @staticmethod
+    def __delitem__(k):
+        raise KeyError(k)
+
+    @staticmethod
+    def __len__():
+        return 0
+
+    @staticmethod
+    def clear():
+        pass
+
+
+def train_zdict(samples, size=None, segment_length=None):
+    """
+    Build a zlib preset dictionary (``zdict``) from a list of sample payloads.
+
+    Substrings that occur in multiple samples are collected, most common
+    first, until the dictionary reaches ``size`` bytes. Small, similarly
+    structured payloads (e.g. pickled dicts) compress a lot better against
+    such a dictionary than on their own.
+
+    >>> samples = [pickle.dumps({'id': i, 'title': 'Title %d' % i, 'type': 'video'}) for i in range(20)]
+    >>> zdict = train_zdict(samples)
+    >>> 0 < len(zdict) <= 32768
+    True
+    >>> compressor = zlib.compressobj(zdict=zdict)
+    >>> compressed = compressor.compress(samples[0]) + compressor.flush()
+    >>> len(compressed) < len(zlib.compress(samples[0]))
+    True
+    >>> train_zdict([b'only one sample'])
+    b''
+
+    :param list samples: list of bytes
+    :param int size: maximum size of the dictionary (zlib only uses the last 32KiB)
+    :param int segment_length: length of the substrings that are considered
+    :rtype: bytes
+    """
+    if size is None:
+        size = 32768
+    if segment_length is None:
+        segment_length = 8
+
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update({sample[i:i + segment_length] for i in range(len(sample) - segment_length + 1)})
+
+    zdict = bytearray()
+    for segment, count in counts.most_common():
+        if count < 2 or len(zdict) >= size:
+            break
+        if segment in zdict:
+            continue
+        # avoid repeating the part that overlaps with the end of the dictionary
+        for overlap in range(segment_length - 1, 0, -1):
+            if zdict.endswith(segment[:overlap]):
+                zdict += segment[overlap:]
+                break
+        else:
+            zdict += segment
+
+    return bytes(zdict[:size])
+
 
 class FileCacher:
+    """
+    Cacher that stores pickled, zlib compressed values as files in a directory.
+
+    When ``zdict`` is given (or trained using :meth:`train_zdict`), values are
+    compressed against a shared preset dictionary, which is stored alongside
+    the cache and loaded by the cachers opened on it later (unless
+    ``zdict=False``). Entries that were written without dictionary stay
+    readable, entries written with another dictionary are treated as a cache
+    miss, and so are entries needing a dictionary when there is none.
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> cache = FileCacher(path)
+    >>> for i in range(10):
+    ...     cache['key%d' % i] = {'id': i, 'title': 'Title %d' % i, 'type': 'video'}
+    >>> cache.train_zdict()
+    True
+    >>> cache['key0']
+    {'id': 0, 'title': 'Title 0', 'type': 'video'}
+    >>> cache['key10'] = {'id': 10, 'title': 'Title 10', 'type': 'video'}
+    >>> FileCacher(path)['key10']
+    {'id': 10, 'title': 'Title 10', 'type': 'video'}
+    """
     suffix = '.cache'
+    zdict_filename = 'zdict'
+    _versioned_re = re.compile(r'v\d+_')
 
-    def __init__(self, path, timeout=None, hasher=None, version=None):
+    def __init__(self, path, timeout=None, hasher=None, version=None, zdict=None):
         self._path = os.path.abspath(path)
         self._timeout = timeout
         self._createpath()
@@ -144,10 +477,16 @@ class FileCacher:
 
         self._compress = zlib.compress
         self._decompress = self._zlib_decompress
+        self._zdict = None
 
         # self._compress = self._reflect_hasher_func
         # self._decompress = self._reflect_hasher_func
 
+        if zdict is None or zdict is True:
+            zdict = self._read_zdict()
+        if zdict:
+            self._set_zdict(zdict)
+
     @staticmethod
     def _zlib_decompress(data):
         try:
@@ -155,6 +494,95 @@ class FileCacher:
         except zlib.error:
             return None
 
+    def _zdict_compress(self, data):
+        compressor = zlib.compressobj(zdict=self._zdict)
+        return compressor.compress(data) + compressor.flush()
+
+    def _zdict_decompress(self, data):
+        # the dictionary is only used if the stream asks for it, so entries
+        # without dictionary can be decompressed as well
+        try:
+            decompressor = zlib.decompressobj(zdict=self._zdict)
+            return decompressor.decompress(data) + decompressor.flush()
+        except zlib.error:
+            return None
+
+    @staticmethod
+    def _uses_zdict(data):
+        # FDICT flag of the zlib header
+        return len(data) >= 2 and bool(data[1] & 0x20)
+
+    def _set_zdict(self, zdict):
+        self._zdict = zdict
+        self._compress = self._zdict_compress
+        self._decompress = self._zdict_decompress
+
+    def _zdict_path(self):
+        filename = type(self).zdict_filename
+        if self._version is not None:
+            filename = 'v%d_%s' % (self._version, filename)
+        return os.path.join(self._path, filename)
+
+    def _read_zdict(self):
+        try:
+            with open(self._zdict_path(), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _cache_files(self):
+        prefix = '' if self._version is None else 'v%d_' % (self._version,)
+        suffix = type(self).suffix
+        for entry in os.scandir(self._path):
+            if not entry.name.startswith(prefix) or not entry.name.endswith(suffix):
+                continue
+            if self._version is None and type(self)._versioned_re.match(entry.name):
+                # entries of a versioned cacher
+                continue
+            if entry.is_file():
+                yield entry.path
+
+    def train_zdict(self, max_samples=None, size=None):
+        """
+        Train a preset dictionary from a sample of the existing cache entries,
+        store it alongside the cache and use it for subsequent reads and writes.
+
+        :param int max_samples: maximum amount of cache entries to sample
+        :param int size: maximum size of the dictionary
+        :return: whether a dictionary could be trained
+        :rtype: bool
+        """
+        if max_samples is None:
+            max_samples = 1000
+
+        filenames = list(self._cache_files())
+        if len(filenames) > max_samples:
+            filenames = random.sample(filenames, max_samples)
+
+        samples = []
+        for filename in filenames:
+            try:
+                with open(filename, 'rb') as f:
+                    sample = self._decompress(f.read())
+            except FileNotFoundError:
+                continue
+            if sample is not None:
+                samples.append(sample)
+
+        zdict = train_zdict(samples, size=size)
+        if not zdict:
+            logger.info('Not enough similar cache entries to train a zdict for %s', self._path)
+            return False
+
+        tmp_filename = '%s.%d.tmp' % (self._zdict_path(), os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(zdict)
+        os.replace(tmp_filename, self._zdict_path())
+
+        logger.debug('Trained zdict of %d bytes from %d entries for %s', len(zdict), len(samples), self._path)
+        self._set_zdict(zdict)
+        return True
+
     def _createpath(self):
         if os.path.exists(self._path):
             return
@@ -203,11 +631,13 @@ class FileCacher:
             raise err
 
         with open(filename, 'rb') as f:
-            to_return = f.read()
-            to_return = self._decompress(to_return)
+            data = f.read()
+            to_return = self._decompress(data)
 
             if to_return is None:
-                os.remove(filename)
+                # keep entries written with a dictionary, for the cachers that have it
+                if self._zdict is not None or not self._uses_zdict(data):
+                    os.remove(filename)
                 raise err
 
             to_return = pickle.loads(to_return)
@@ -221,6 +651,22 @@ class FileCacher:
         except KeyError:
             return False
 
+    def __delitem__(self, k):
+        try:
+            os.remove(self._filename(k))
+        except FileNotFoundError:
+            raise KeyError(k)
+
+    def __len__(self):
+        return sum(1 for _ in self._cache_files())
+
+    def clear(self):
+        for filename in self._cache_files():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
 
 class CacheProxy:
     def __init__(self, cacher):
@@ -235,6 +681,12 @@ class CacheProxy:
     def __contains__(self, item):
         return self.cacher.__contains__(item)
 
+    def __delitem__(self, key):
+        return self.cacher.__delitem__(key)
+
+    def clear(self):
+        return self.cacher.clear()
+
 
 class CacheLocker(CacheProxy):
     def __init__(self, cacher):
@@ -330,6 +782,21 @@ class CacheAggregate:
             except Exception as e:
                 logger.warning("cacheaggregator set exception %s", e)
 
+    def __delitem__(self, k):
+        deleted = False
+        for cacher in self.cachers:
+            try:
+                del cacher[k]
+                deleted = True
+            except KeyError:
+                pass
+        if not deleted:
+            raise KeyError(k)
+
+    def clear(self):
+        for cacher in self.cachers:
+            cacher.clear()
+
 
 class OptimizedFileCacher(CacheProxy):
     def __init__(self, path, max_local_items=None, *args, **kwargs):
@@ -1,14 +1,24 @@
 import logging
 
-from .cache import LocalCacher, DummyCacher
-from functools import partial
+from .cache import LocalCacher, CacheKey, uses_hashable_keys
+from collections import namedtuple, Counter, deque
+from concurrent.futures import Future
+from functools import partial, wraps
+from itertools import count
+import random
+import threading
 import time
+import weakref
 
 _log = logging.getLogger(__name__)
 # _log.propagate = True
 _log.setLevel(logging.WARNING)
 _log = _log.debug
 
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'maxsize', 'currsize', 'time_saved'))
+# cached result of a function memoized with a ttl, told apart from results that are tuples themselves
+_Expiring = namedtuple('_Expiring', ('expires', 'value'))
+
 
 class DeferredStr:
     """Simple helper class to defer the execution of formatting functions until it is needed"""
@@ -23,11 +33,7 @@ class DeferredStr:
         return self.__str__()
 
 
-def _get_cache_key(*args, **kwargs):
-    return '||'.join(('|'.join(map(str, args)), '|'.join(kwargs.items())))
-
-
-def log_call(logger: logging.Logger, log_level=None, result=None):
+def log_call(logger: logging.Logger, log_level=None, result=None, sample=None, timing=False):
     """
     Decorator to log all calls to decorated function to given logger
 
@@ -52,13 +58,41 @@ def log_call(logger: logging.Logger, log_level=None, result=None):
     DEBUG:logger_name: test(arg2='someval', arg3='someotherval')
     DEBUG:logger_name: test returned: result
     'result'
+
+    Nothing is formatted (or timed) when the log level is disabled, and with
+    ``sample`` only 1 in ``sample`` calls gets logged:
+
+    >>> @log_call(logger, sample=2, timing=True)
+    ... def test(arg):
+    ...     return arg
+    >>> [test(i) for i in range(3)]  # doctest: +ELLIPSIS
+    DEBUG:logger_name: test(0)
+    DEBUG:logger_name: test took ...ms
+    DEBUG:logger_name: test(2)
+    DEBUG:logger_name: test took ...ms
+    [0, 1, 2]
+    >>> logger.setLevel(logging.INFO)
+    >>> test(3)
+    3
+
+    :param logging.Logger logger: logger to log to
+    :param int log_level: level to log with, defaults to ``logging.DEBUG``
+    :param bool result: whether to log the returned value as well
+    :param int sample: only log 1 in ``sample`` calls
+    :param bool timing: whether to log the duration of the call as well
     """
 
     if log_level is None:
         log_level = logging.DEBUG
 
     def _log_call(func: callable):
+        counter = count()
+
+        @wraps(func)
         def _(*args, **kwargs):
+            if not logger.isEnabledFor(log_level) or (sample is not None and next(counter) % sample):
+                return func(*args, **kwargs)
+
             arguments_format = []
             arguments_list = []
             if len(args):
@@ -71,7 +105,10 @@ def log_call(logger: logging.Logger, log_level=None, result=None):
             arguments_format = '%s(%s)' % (func.__name__, ', '.join(arguments_format))
 
             logger.log(log_level, arguments_format, *arguments_list)
+            start = time.monotonic() if timing else None
             result_ = func(*args, **kwargs)
+            if timing:
+                logger.log(log_level, '%s took %.2fms', func.__name__, (time.monotonic() - start) * 1000)
             if result:
                 logger.log(log_level, '%s returned: %s', func.__name__, result_)
             return result_
@@ -108,7 +145,339 @@ def exception_redirect(new_exception_class, old_exception_class=Exception, logge
     return _decorator
 
 
-def memoize(f, cacher=None):
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker, shared between all threads (and functions) using it.
+
+    While closed, the outcome of the last ``window_size`` calls is kept. Once
+    there were at least ``minimum_calls``, the circuit opens when the rate of
+    failed calls reaches ``failure_rate``, or the rate of calls slower than
+    ``slow_call_duration`` seconds reaches ``slow_call_rate``. While open,
+    calls fail fast. After ``reset_timeout`` seconds it becomes half open and
+    lets ``half_open_calls`` trial calls through: if all succeed it closes,
+    if any fails it opens again.
+
+    >>> breaker = CircuitBreaker(window_size=4, minimum_calls=2, reset_timeout=.05)
+    >>> @breaker
+    ... def test(fail):
+    ...     if fail:
+    ...         raise ValueError("failed")
+    ...     return 'ok'
+    >>> test(False)
+    'ok'
+    >>> test(True)
+    Traceback (most recent call last):
+    ...
+    ValueError: failed
+    >>> breaker.state
+    'open'
+    >>> test(False)
+    Traceback (most recent call last):
+    ...
+    lump.decorators.CircuitOpenError: circuit is open
+    >>> time.sleep(.06)
+    >>> breaker.state
+    'half_open'
+    >>> test(False)
+    'ok'
+    >>> breaker.state
+    'closed'
+
+    :param float failure_rate: rate of failed calls (0-1) at which the circuit opens
+    :param float slow_call_rate: rate of slow calls (0-1) at which the circuit opens
+    :param float slow_call_duration: seconds after which a call is considered slow
+    :param int window_size: amount of calls to calculate the rates over
+    :param int minimum_calls: minimum amount of calls before the circuit can open
+    :param float reset_timeout: seconds the circuit stays open before going half open
+    :param int half_open_calls: amount of trial calls done while half open
+    :param exceptions: exception class (or tuple of classes) counted as failure
+    :param logging.Logger logger: logs the state changes
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate=.5, slow_call_rate=1., slow_call_duration=None, window_size=20,
+                 minimum_calls=10, reset_timeout=30, half_open_calls=1, exceptions=Exception, logger=None):
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_duration = slow_call_duration
+        self.minimum_calls = minimum_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.exceptions = exceptions
+        self.logger = logger
+        self._window = deque(maxlen=window_size)
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trials = 0
+        self._trial_successes = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if self.logger is not None:
+            self.logger.warning('Circuit breaker state change: %s -> %s', self._state, state)
+        self._state = state
+        self._window.clear()
+        self._trials = 0
+        self._trial_successes = 0
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+
+    def _update_state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update_state()
+            return self._state
+
+    def allow(self):
+        """
+        Whether a call is allowed right now, reserves a trial call when half open
+
+        :rtype: bool
+        """
+        with self._lock:
+            self._update_state()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return True
+            return False
+
+    def record(self, failed, duration=None):
+        """
+        Record the outcome of an allowed call
+
+        :param bool failed: whether the call failed
+        :param float duration: duration of the call in seconds
+        """
+        slow = self.slow_call_duration is not None and duration is not None and duration > self.slow_call_duration
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                if failed or slow:
+                    self._set_state(self.OPEN)
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= self.half_open_calls:
+                        self._set_state(self.CLOSED)
+                return
+
+            if self._state != self.CLOSED:
+                return
+
+            window = self._window
+            window.append((failed, slow))
+            if len(window) < self.minimum_calls:
+                return
+            failures = sum(1 for failed, _ in window if failed)
+            slow_calls = sum(1 for _, slow in window if slow)
+            if failures / len(window) >= self.failure_rate or slow_calls / len(window) >= self.slow_call_rate:
+                self._set_state(self.OPEN)
+
+    def release(self):
+        """Give back the trial call reserved by :meth:`allow`, for a call without an outcome"""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def reset(self):
+        with self._lock:
+            self._set_state(self.CLOSED)
+
+    def call(self, func, *args, fallback=None, **kwargs):
+        if not self.allow():
+            if fallback is not None:
+                return fallback(*args, **kwargs)
+            raise CircuitOpenError("circuit is open")
+
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except self.exceptions:
+            self.record(True, time.monotonic() - start)
+            raise
+        except BaseException:
+            # e.g. KeyboardInterrupt, neither a success nor a failure
+            self.release()
+            raise
+        self.record(False, time.monotonic() - start)
+        return result
+
+    def __call__(self, func):
+        return circuit_breaker(self)(func)
+
+
+def circuit_breaker(breaker=None, fallback=None, **kwargs):
+    """
+    Decorator failing fast (or returning ``fallback(*args, **kwargs)``) while
+    the circuit is open, e.g. to serve stale cache values.
+
+    >>> stale = {'a': 'stale value'}
+    >>> @circuit_breaker(fallback=lambda key: stale[key], minimum_calls=1)
+    ... def get(key):
+    ...     raise IOError("backend down")
+    >>> get('a')
+    Traceback (most recent call last):
+    ...
+    OSError: backend down
+    >>> get('a')
+    'stale value'
+    >>> get.circuit_breaker.state
+    'open'
+
+    :param CircuitBreaker breaker: shared breaker to use, by default a new one is
+        created using the given keyword arguments
+    :param callable fallback: called with the same arguments while the circuit is open
+
+    .. seealso:: :class:`CircuitBreaker`
+    """
+    if breaker is None:
+        breaker = CircuitBreaker(**kwargs)
+    elif kwargs:
+        raise ValueError("Can't pass both a CircuitBreaker and arguments to create one")
+
+    def _decorator(func):
+        @wraps(func)
+        def _(*args, **kwargs):
+            return breaker.call(func, *args, fallback=fallback, **kwargs)
+        _.circuit_breaker = breaker
+        return _
+    return _decorator
+
+
+class _Batcher:
+    def __init__(self, func, max_size, max_wait):
+        self.func = func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._batch = []
+        self._cond = threading.Condition()
+
+    def __call__(self, item):
+        future = Future()
+        to_run = None
+        with self._cond:
+            batch = self._batch
+            batch.append((item, future))
+            if len(batch) >= self.max_size:
+                self._batch = []
+                self._cond.notify_all()
+                to_run = batch
+            elif len(batch) == 1:
+                # first caller waits for the batch to fill up, or max_wait to pass
+                deadline = time.monotonic() + self.max_wait
+                while self._batch is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._batch = []
+                        to_run = batch
+                        break
+                    self._cond.wait(remaining)
+
+        if to_run is not None:
+            self._run(to_run)
+        return future.result()
+
+    def _run(self, batch):
+        try:
+            # the same item requested by multiple callers is only passed once
+            items = list(dict.fromkeys(item for item, _ in batch))
+        except TypeError:
+            items = None
+
+        try:
+            if items is None:
+                results = self._results(self.func([item for item, _ in batch]), batch)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+                return
+            results = self.func(items)
+            if not isinstance(results, dict):
+                results = dict(zip(items, self._results(results, items)))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for item, future in batch:
+            try:
+                future.set_result(results[item])
+            except KeyError as e:
+                future.set_exception(e)
+
+    @staticmethod
+    def _results(results, items):
+        results = list(results)
+        if len(results) != len(items):
+            raise ValueError("Batch function returned %d results for %d items" % (len(results), len(items)))
+        return results
+
+
+def batched(max_size=100, max_wait=.005):
+    """
+    Decorator combining calls for single items from many threads into one
+    call of the decorated batch function (the dataloader pattern).
+
+    The decorated function gets a list of (unique) items and returns either
+    a list of results in the same order, or a dict mapping items to results.
+    Calls wait at most ``max_wait`` seconds for the batch to fill up to
+    ``max_size`` items.
+
+    >>> from lump.multithreading import multithreaded
+    >>> batches = []
+    >>> @batched(max_size=10, max_wait=.05)
+    ... def double(ids):
+    ...     batches.append(len(ids))
+    ...     return {i: i * 2 for i in ids}
+    >>> @multithreaded(10)
+    ... def process(n, thread_id):
+    ...     return double(n)
+    >>> sorted(process(range(20)))[:5]
+    [0, 2, 4, 6, 8]
+    >>> len(batches) < 20
+    True
+
+    Combined with :func:`memoize` (applied on top), cached items never
+    enter a batch:
+
+    >>> @cache()
+    ... @batched(max_wait=0)
+    ... def get(ids):
+    ...     print(ids)
+    ...     return ids
+    >>> get(1), get(1)
+    [1]
+    (1, 1)
+
+    :param int max_size: maximum amount of items per batch
+    :param float max_wait: seconds to wait for more items before calling the batch function
+    """
+    def _decorator(func):
+        batcher = _Batcher(func, max_size, max_wait)
+
+        @wraps(func)
+        def _(item):
+            return batcher(item)
+        _.batch_function = func
+        return _
+    return _decorator
+
+
+def _key_prefix(f):
+    """Prefix for keys of ``f`` in a cacher that may be shared with other functions"""
+    return (getattr(f, '__module__', None), getattr(f, '__qualname__', repr(f)))
+
+
+def memoize(f, cacher=None, key=None, ttl=None, max_size=None):
     """Usage:
 
     >>> called = 0
@@ -122,27 +491,102 @@ def memoize(f, cacher=None):
     1
     >>> someFunc()
     1
+
+    Like :func:`functools.lru_cache`, the decorated function can be inspected
+    and controlled:
+
+    >>> someFunc.cache_info()  # doctest: +ELLIPSIS
+    CacheInfo(hits=1, misses=1, maxsize=50, currsize=1, time_saved=...)
+    >>> someFunc.cache_delete()
+    True
+    >>> someFunc()
+    2
+    >>> someFunc.cache_clear()
+    >>> someFunc.cache_info()
+    CacheInfo(hits=0, misses=0, maxsize=50, currsize=0, time_saved=0.0)
+
+    A given cacher may be shared with other functions, so by default its keys
+    are prefixed with the name of the function, ``cache_info`` doesn't report
+    its size and ``cache_clear`` can't be used (clear the cacher itself).
+
+    :param callable f: function to cache
+    :param cacher: any cacher from :mod:`lump.cache`
+    :param CacheKey key: builds the cache keys, see :class:`lump.cache.CacheKey`
+    :param float ttl: amount of seconds a result stays valid
+    :param int max_size: maximum amount of results kept when no cacher is given
     """
-    if cacher is None:
-        cacher = LocalCacher(max_items=50)
+    shared = cacher is not None
+    if not shared:
+        cacher = LocalCacher(max_items=50 if max_size is None else max_size)
+    max_size = getattr(cacher, 'max_items', None)
+
+    if key is None:
+        key = CacheKey(f, prefix=_key_prefix(f) if shared else None)
+
+    get_key = key if uses_hashable_keys(cacher) else key.digest
+    stats = {'hits': 0, 'misses': 0, 'miss_time': 0.}
 
+    @wraps(f)
     def _cacher(*args, **kwargs):
-        global _log
-        x = _get_cache_key(*args, **kwargs)
+        x = get_key(*args, **kwargs)
 
-        if x in cacher:
-            _log('%s(%s): got: %s', memoize.__name__, f.__name__, DeferredStr(x))
-            return cacher[x]
+        try:
+            res = cacher[x]
+        except KeyError:
+            pass
+        else:
+            if isinstance(res, _Expiring):
+                valid = res.expires > time.time()
+                res = res.value
+            else:
+                # cached without a ttl, e.g. before the ttl was added
+                valid = ttl is None
+            if valid:
+                stats['hits'] += 1
+                _log('%s(%s): got: %s', memoize.__name__, f.__name__, x)
+                return res
 
+        start = time.monotonic()
         res = f(*args, **kwargs)
-        _log('%s(%s): set: %s', memoize.__name__, f.__name__, DeferredStr(x))
-        cacher[x] = res
+        stats['miss_time'] += time.monotonic() - start
+        stats['misses'] += 1
+        _log('%s(%s): set: %s', memoize.__name__, f.__name__, x)
+        cacher[x] = res if ttl is None else _Expiring(time.time() + ttl, res)
         return res
 
+    def cache_info():
+        """Report cache statistics, ``time_saved`` is estimated from the average duration of a miss"""
+        hits, misses = stats['hits'], stats['misses']
+        currsize = None
+        if not shared:
+            currsize = len(cacher)
+        time_saved = hits * stats['miss_time'] / misses if misses else 0.
+        return CacheInfo(hits, misses, max_size, currsize, time_saved)
+
+    def cache_clear():
+        """Clear the cache and its statistics"""
+        if shared:
+            raise ValueError("Can't clear the results of %s from a shared cacher, clear the cacher itself"
+                             % (f.__qualname__,))
+        cacher.clear()
+        stats.update(hits=0, misses=0, miss_time=0.)
+
+    def cache_delete(*args, **kwargs):
+        """Remove the cached result for the given arguments, returns whether there was one"""
+        try:
+            del cacher[get_key(*args, **kwargs)]
+            return True
+        except KeyError:
+            return False
+
+    _cacher.cache_info = cache_info
+    _cacher.cache_clear = cache_clear
+    _cacher.cache_delete = cache_delete
+    _cacher.cacher = cacher
     return _cacher
 
 
-def cache(cacher=None):
+def cache(cacher=None, typed=False, key_funcs=None, ignore=None, ttl=None, max_size=None):
     """Usage:
 
     >>> @cache()
@@ -155,13 +599,33 @@ def cache(cacher=None):
     'result'
     >>> test()
     'result'
+    >>> @cache(ignore=['session'], key_funcs={'name': str.lower})
+    ... def greet(name, session=None):
+    ...   print('greet')
+    ...   return 'Hello %s' % (name,)
+    >>> greet('World', session=1)
+    greet
+    'Hello World'
+    >>> greet('WORLD', session=2)
+    'Hello World'
+
+    :param cacher: any cacher from :mod:`lump.cache`
+    :param bool typed: whether arguments of different types are cached separately
+    :param dict key_funcs: mapping of argument names to functions returning the value to use in the key
+    :param list ignore: names of arguments that should not be part of the key
+    :param float ttl: amount of seconds a result stays valid
+    :param int max_size: maximum amount of results kept when no cacher is given
+
+    .. seealso:: :func:`memoize`
     """
     def _(f):
-        return memoize(f, cacher=cacher)
+        key = CacheKey(f, typed=typed, key_funcs=key_funcs, ignore=ignore,
+                       prefix=None if cacher is None else _key_prefix(f))
+        return memoize(f, cacher=cacher, key=key, ttl=ttl, max_size=max_size)
     return _
 
 
-def classcache(f):
+def classcache(f=None, per_instance=False, max_size=None):
     """Usage:
 
     >>> class SomeClass:
@@ -193,34 +657,279 @@ def classcache(f):
     1
     >>> cls.someFunc()
     1
+
+    The cacher (and key prefix) is resolved once per instance, use
+    ``cache_reset(obj)`` if ``get_cacher()`` starts returning another cacher.
+    With ``per_instance=True`` each instance gets its own
+    :class:`lump.cache.LocalCacher`, which is released together with the
+    instance:
+
+    >>> class SomeOtherClass(SomeClass):
+    ...     @classcache(per_instance=True, max_size=10)
+    ...     def someFunc(self):
+    ...         self._call_count += 1
+    ...         return self._call_count
+    >>> cls = SomeOtherClass()
+    >>> cls.someFunc(), cls.someFunc(), SomeOtherClass().someFunc()
+    (1, 1, 1)
+    >>> SomeOtherClass.someFunc.cache_size()
+    1
+    >>> del cls
+    >>> SomeOtherClass.someFunc.cache_size()
+    0
+
+    :param callable f: method to cache
+    :param bool per_instance: use a separate cache for each instance instead of ``get_cacher()``
+    :param int max_size: maximum amount of results kept per instance if ``per_instance``
     """
-    def _cacher(*args, **kwargs):
-        global _log
-        obj = args[0]
-        cacher = obj.get_cacher() if hasattr(obj, 'get_cacher') else None
-        if not cacher:
-            cacher = DummyCacher()
-        x = _get_cache_key(f.__name__, *args[1:], **kwargs)
+    if f is None:
+        return partial(classcache, per_instance=per_instance, max_size=max_size)
+
+    key = CacheKey()
+    # resolved (weakref, cacher, key prefix, hashable keys) per instance, keyed by id(instance)
+    states = {}
+
+    def _resolve(obj):
+        if per_instance:
+            cacher = LocalCacher(max_size)
+        else:
+            get_cacher = getattr(obj, 'get_cacher', None)
+            cacher = get_cacher() if get_cacher is not None else None
+
+        prefix = (f.__name__,)
+        version = getattr(type(obj), 'classcacheVersionNumber', None)
+        if version is not None:
+            prefix += ('v:%d' % (version,),)
 
-        if hasattr(obj.__class__, 'classcacheVersionNumber'):
-            x = '%s|v:%d' % (x, obj.__class__.classcacheVersionNumber)
-            _log('version keyed: %s', x)
+        obj_id = id(obj)
+        try:
+            ref = weakref.ref(obj, lambda _: states.pop(obj_id, None))
+        except TypeError:
+            # not weakref-able, can't keep state for this instance
+            ref = None
+
+        state = (ref, cacher, prefix, cacher is not None and uses_hashable_keys(cacher))
+        if ref is not None:
+            states[obj_id] = state
+        return state
 
+    @wraps(f)
+    def _cacher(obj, *args, **kwargs):
         try:
-            _log('%s.%s:%s got: %s', obj.__class__.__name__, f.__name__, classcache.__name__, DeferredStr(x))
-            return cacher[x]
+            _, cacher, prefix, hashable_keys = states[id(obj)]
+        except KeyError:
+            _, cacher, prefix, hashable_keys = _resolve(obj)
+
+        if cacher is None:
+            return f(obj, *args, **kwargs)
+
+        if hashable_keys:
+            x = key(*prefix, *args, **kwargs)
+        else:
+            x = key.digest(*prefix, *args, **kwargs)
+
+        try:
+            res = cacher[x]
+            _log('%s.%s:%s got: %s', type(obj).__name__, f.__name__, classcache.__name__, x)
+            return res
         except KeyError:
             pass
 
-        res = f(*args, **kwargs)
-        _log('%s.%s:%s set: %s', obj.__class__.__name__, f.__name__, classcache.__name__, DeferredStr(x))
+        res = f(obj, *args, **kwargs)
+        _log('%s.%s:%s set: %s', type(obj).__name__, f.__name__, classcache.__name__, x)
         cacher[x] = res
         return res
 
+    def cache_reset(obj):
+        """Forget the resolved cacher for the given instance"""
+        states.pop(id(obj), None)
+
+    def cache_size():
+        """Amount of instances with a resolved cacher"""
+        return len(states)
+
+    _cacher.cache_reset = cache_reset
+    _cacher.cache_size = cache_size
     return _cacher
 
 
-def retry(tries=5, logger=None, sleep=None):
+class RetryBudget:
+    """
+    Token bucket limiting the amount of retries across all callers sharing it,
+    to avoid retry amplification when a dependency starts failing.
+
+    Every call deposits ``ratio`` tokens (up to ``max_tokens``), every retry
+    withdraws one, so at most about ``ratio`` retries per call are done on
+    average, with ``min_retries_per_second`` retries always allowed.
+
+    >>> budget = RetryBudget(ratio=.5, max_tokens=1, min_retries_per_second=0)
+    >>> budget.deposit()
+    >>> budget.withdraw()
+    False
+    >>> budget.deposit()
+    >>> budget.withdraw()
+    True
+    >>> budget.withdraw()
+    False
+
+    :param float ratio: amount of retries allowed per call
+    :param float max_tokens: maximum amount of saved up retries
+    :param float min_retries_per_second: amount of retries always allowed
+    """
+
+    def __init__(self, ratio=.2, max_tokens=10, min_retries_per_second=1):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.min_retries_per_second = min_retries_per_second
+        self._tokens = 0.
+        self._reserve = float(min_retries_per_second)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Take a token for a retry
+
+        :return: whether the retry is allowed
+        :rtype: bool
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = self.min_retries_per_second
+            self._reserve = min(rate, self._reserve + (now - self._last_refill) * rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            if self._reserve >= 1:
+                self._reserve -= 1
+                return True
+            return False
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, allowing ``rate`` acquisitions per second with
+    bursts of up to ``burst``.
+
+    Acquiring reserves the tokens right away and sleeps until they're
+    available, so waiting threads are served in order without busy looping.
+
+    >>> bucket = TokenBucket(rate=100, burst=2)
+    >>> bucket.acquire(), bucket.acquire()
+    (True, True)
+    >>> bucket.acquire(blocking=False)
+    False
+    >>> start = time.monotonic()
+    >>> bucket.acquire()
+    True
+    >>> time.monotonic() - start > .005
+    True
+
+    :param float rate: amount of tokens added per second
+    :param float burst: maximum amount of tokens, by default ``max(1, rate)``
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate should be > 0")
+        self.rate = rate
+        self.burst = max(1, rate) if burst is None else burst
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1, blocking=True, timeout=None):
+        """
+        :param float tokens: amount of tokens to take
+        :param bool blocking: whether to wait for the tokens to become available
+        :param float timeout: maximum amount of seconds to wait
+        :return: whether the tokens were acquired
+        :rtype: bool
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            wait = (tokens - self._tokens) / self.rate
+            if not blocking or (timeout is not None and wait > timeout):
+                return False
+            # reserve the tokens, later callers wait for the ones after these
+            self._tokens -= tokens
+        time.sleep(wait)
+        return True
+
+
+def rate_limited(rate=None, burst=None, key=None, bucket=None):
+    """
+    Decorator limiting the amount of calls per second across all threads.
+
+    >>> @rate_limited(1000, burst=1)
+    ... def test(host):
+    ...     return host
+    >>> start = time.monotonic()
+    >>> [test('a') for _ in range(11)]  # doctest: +ELLIPSIS
+    ['a', ...]
+    >>> time.monotonic() - start >= .01
+    True
+
+    With ``key``, every key (e.g. host) gets its own bucket:
+
+    >>> @rate_limited(1, key=lambda host, path: host)
+    ... def get(host, path):
+    ...     return host + path
+    >>> get('a', '/1'), get('b', '/1')
+    ('a/1', 'b/1')
+    >>> sorted(get.buckets)
+    ['a', 'b']
+
+    :param float rate: amount of calls per second
+    :param float burst: maximum amount of calls in a burst
+    :param callable key: gets the call arguments, returns the key to rate limit on
+    :param TokenBucket bucket: shared bucket to use instead of creating one, not combinable with ``key``
+    """
+    if bucket is None and rate is None:
+        raise ValueError("Expected either rate or bucket")
+    if bucket is not None and key is not None:
+        raise ValueError("Can't combine a shared bucket with key, every key gets its own bucket of rate")
+
+    def _decorator(func):
+        buckets = {}
+        lock = threading.Lock()
+
+        def _bucket(k):
+            try:
+                return buckets[k]
+            except KeyError:
+                with lock:
+                    return buckets.setdefault(k, TokenBucket(rate, burst))
+
+        if key is None:
+            shared = bucket if bucket is not None else TokenBucket(rate, burst)
+
+        @wraps(func)
+        def _(*args, **kwargs):
+            (shared if key is None else _bucket(key(*args, **kwargs))).acquire()
+            return func(*args, **kwargs)
+
+        _.buckets = buckets
+        return _
+    return _decorator
+
+
+RetryInfo = namedtuple('RetryInfo', ('calls', 'attempts', 'successes', 'failures', 'budget_exhausted',
+                                     'sleep_time', 'successes_per_attempt'))
+
+
+def retry(tries=5, logger=None, sleep=None, backoff=None, max_sleep=None, jitter=False,
+          exceptions=Exception, retry_on_result=None, budget=None, callback=None):
     """
     Automagically retry the action
 
@@ -246,19 +955,106 @@ def retry(tries=5, logger=None, sleep=None):
     Traceback (most recent call last):
     ...
     Exception: nope
+    >>> info = a.retry_info()
+    >>> info.calls, info.attempts, info.successes, info.failures
+    (5, 16, 4, 1)
+    >>> info.successes_per_attempt
+    {4: 1, 1: 2, 5: 1}
+
+    With exponential backoff and full jitter, the n-th retry sleeps a random
+    time between 0 and ``min(max_sleep, sleep * backoff ** (n - 1))`` seconds.
+    Only ``exceptions`` are retried, and results for which ``retry_on_result``
+    returns True are retried as well (the last one is returned):
+
+    >>> @retry(3, sleep=.001, backoff=2, max_sleep=.1, jitter=True, exceptions=(ValueError,),
+    ...        retry_on_result=lambda res: res is None)
+    ... def b(value):
+    ...     if value == 'type':
+    ...         raise TypeError(value)
+    ...     print('try')
+    >>> b('type')
+    Traceback (most recent call last):
+    ...
+    TypeError: type
+    >>> b(None)
+    try
+    try
+    try
+
+    :param int tries: maximum amount of attempts
+    :param logging.Logger logger: logs the exceptions
+    :param float sleep: seconds to wait before the first retry, required by ``backoff``,
+        ``max_sleep`` and ``jitter``
+    :param float backoff: multiplier for the wait time after each retry
+    :param float max_sleep: maximum amount of seconds to wait between attempts
+    :param bool jitter: use a random wait time between 0 and the calculated one
+    :param exceptions: exception class (or tuple of classes) to retry on
+    :param callable retry_on_result: gets the result, retries if it returns True
+    :param RetryBudget budget: shared retry budget, no retries are done when it is exhausted
+    :param callable callback: called after every failed attempt with the attempt number, exception
+        (or None) and the amount of seconds that will be waited (or None if there's no retry)
     """
+    if sleep is None and (backoff is not None or max_sleep is not None or jitter):
+        raise ValueError("backoff, max_sleep and jitter need a base sleep time")
+
     def _(f):
+        stats = {'calls': 0, 'attempts': 0, 'successes': 0, 'failures': 0, 'budget_exhausted': 0, 'sleep_time': 0.}
+        successes_per_attempt = Counter()
+
+        def _delay(i):
+            if sleep is None:
+                return None
+            delay = sleep if backoff is None else sleep * backoff ** i
+            if max_sleep is not None:
+                delay = min(delay, max_sleep)
+            if jitter:
+                delay = random.uniform(0, delay)
+            return delay
+
+        @wraps(f)
         def _decorator(*args, **kwargs):
             func = partial(f, *args, **kwargs)
+            stats['calls'] += 1
+            if budget is not None:
+                budget.deposit()
+
             for i in range(tries):
+                stats['attempts'] += 1
+                error = None
                 try:
-                    return func()
-                except Exception as e:
+                    result = func()
+                except exceptions as e:
                     if logger:
                         logger.exception(e)
-                    if i + 1 == tries:
-                        raise e
-                    if sleep is not None:
-                        time.sleep(sleep)
+                    error = e
+                else:
+                    if retry_on_result is None or not retry_on_result(result):
+                        stats['successes'] += 1
+                        successes_per_attempt[i + 1] += 1
+                        return result
+
+                is_last = i + 1 == tries
+                if not is_last and budget is not None and not budget.withdraw():
+                    stats['budget_exhausted'] += 1
+                    is_last = True
+
+                delay = None if is_last else _delay(i)
+                if callback is not None:
+                    callback(i + 1, error, delay)
+
+                if is_last:
+                    stats['failures'] += 1
+                    if error is not None:
+                        raise error
+                    return result
+
+                if delay:
+                    stats['sleep_time'] += delay
+                    time.sleep(delay)
+
+        def retry_info():
+            return RetryInfo(successes_per_attempt=dict(successes_per_attempt), **stats)
+
+        _decorator.retry_info = retry_info
         return _decorator
     return _
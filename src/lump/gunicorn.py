@@ -6,6 +6,7 @@ import psutil
 import logging
 import os
 from lump.humanreadable import format_metric
+from lump.profiling import install_profiler_toggle, register_profiler_command, install_memory_signals
 
 logger = logging.getLogger(__name__)
 
@@ -72,17 +73,61 @@ class GunicornInteractiveApplication(GunicornApplication):
     def _init_(self):
         self.main_pid = os.getpid()
         self.main_process = psutil.Process(self.main_pid)
+        # process running gunicorn's arbiter, started by run
+        self.arbiter = None
         self.keypress_handler = InteractiveTerminalHandler()
-        self.keypress_handler.register('mem', self._show_memory, 'Output current memory usage')
+        self.keypress_handler.register('mem', self._show_memory,
+                                       'Output current memory usage, "mem snapshot" to start tracking '
+                                       'allocations, "mem diff" to report the growth since then')
+        # installed before forking, so gunicorn's master and workers inherit them
+        try:
+            self.memory_signals = dict(zip(('snapshot', 'diff'), install_memory_signals()))
+        except ValueError as e:
+            logger.info('Memory snapshots are not available: %s', e)
+            self.memory_signals = {}
+        try:
+            self.profile_signal = install_profiler_toggle()
+        except ValueError as e:
+            logger.info('The profile command is not available: %s', e)
+            self.profile_signal = None
+        else:
+            register_profiler_command(self.keypress_handler, self._pids, self.profile_signal)
 
     def run(self):
-        process = Process(target=super().run)
-        process.start()
+        self.arbiter = Process(target=super().run)
+        self.arbiter.start()
         self.keypress_handler.start()
-        process.join()
+        self.arbiter.join()
 
     def print_help(self):
         self.keypress_handler.options.print_help()
 
-    def _show_memory(self):
-        print('Current memory usage: %s' % (format_metric(self.main_process.memory_info().rss),))
+    def _pids(self):
+        """
+        The gunicorn arbiter and its workers, not the processes they started:
+        those don't handle the signals, so most would be terminated by them.
+        """
+        if self.arbiter is None or self.arbiter.pid is None:
+            return []
+        try:
+            arbiter = psutil.Process(self.arbiter.pid)
+            return [arbiter.pid] + [process.pid for process in arbiter.children()]
+        except psutil.NoSuchProcess:
+            return []
+
+    def _show_memory(self, action=None):
+        if action is None:
+            print('Current memory usage: %s' % (format_metric(self.main_process.memory_info().rss),))
+            return
+
+        if not self.memory_signals:
+            print('Memory snapshots are not available on this platform')
+            return
+
+        if action not in self.memory_signals:
+            print('Unknown action %r, expected one of: %s' % (action, ', '.join(self.memory_signals)))
+            return
+
+        for pid in self._pids():
+            if pid != os.getpid():
+                os.kill(pid, self.memory_signals[action])
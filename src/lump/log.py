@@ -0,0 +1,168 @@
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full, Empty
+import logging
+import threading
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    QueueHandler for a bounded queue, that either drops records when the queue
+    is full (``policy='drop'``), or blocks until there is room (``policy='block'``,
+    for at most ``timeout`` seconds, after which the record is dropped).
+
+    >>> handler = BoundedQueueHandler(Queue(maxsize=1))
+    >>> logger = logging.getLogger('lump.log.doctest')
+    >>> logger.addHandler(handler)
+    >>> logger.warning('first')
+    >>> logger.warning('second')
+    >>> handler.dropped
+    1
+    >>> logger.removeHandler(handler)
+
+    :param queue.Queue queue: the queue to put records on
+    :param str policy: ``'drop'`` or ``'block'``
+    :param float timeout: maximum amount of seconds to block with ``policy='block'``
+    """
+    policies = ('drop', 'block')
+
+    def __init__(self, queue, policy=None, timeout=None):
+        super().__init__(queue)
+        if policy is None:
+            policy = 'drop'
+        if policy not in self.policies:
+            raise ValueError("Unknown policy %r, expected one of %s" % (policy, ', '.join(self.policies)))
+        self.policy = policy
+        self.timeout = timeout
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    QueueListener that handles the available records in batches of up to
+    ``batch_size`` and flushes its handlers once per batch.
+    """
+
+    def __init__(self, queue, *handlers, respect_handler_level=True, batch_size=None):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self.batch_size = 100 if batch_size is None else batch_size
+
+    def enqueue_sentinel(self):
+        # wait for room instead of failing when the queue is full
+        self.queue.put(self._sentinel)
+
+    def _monitor(self):
+        q = self.queue
+        has_task_done = hasattr(q, 'task_done')
+        stop = False
+        while not stop:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except Empty:
+                    break
+
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+                if has_task_done:
+                    q.task_done()
+
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except Exception:
+                    pass
+
+
+class QueueLogging:
+    """
+    Moves the handlers of a logger behind a bounded queue, handled by a
+    background thread, so logging from hot paths only costs an enqueue (and
+    formatting the message) no matter how slow the handlers are.
+
+    >>> import sys
+    >>> logger = logging.getLogger('lump.log.queuelogging')
+    >>> logger.propagate = False
+    >>> handler = logging.StreamHandler(sys.stdout)
+    >>> logger.addHandler(handler)
+    >>> with QueueLogging(logger, maxsize=100) as queue_logging:
+    ...     logger.warning('logged from the background')
+    logged from the background
+    >>> logger.handlers == [handler]
+    True
+    >>> queue_logging.dropped
+    0
+
+    :param logging.Logger logger: the logger, by default the root logger
+    :param list handlers: handlers to use, by default the current handlers of the logger
+    :param int maxsize: maximum amount of records waiting to be handled
+    :param str policy: ``'drop'`` or ``'block'`` when the queue is full, see :class:`BoundedQueueHandler`
+    :param float timeout: maximum amount of seconds to block with ``policy='block'``
+    :param int batch_size: maximum amount of records handled before flushing the handlers
+    """
+
+    def __init__(self, logger=None, handlers=None, maxsize=None, policy=None, timeout=None, batch_size=None):
+        if logger is None:
+            logger = logging.getLogger()
+        if maxsize is None:
+            maxsize = 10000
+        self.logger = logger
+        self.handlers = list(logger.handlers if handlers is None else handlers)
+        self.queue = Queue(maxsize=maxsize)
+        self.handler = BoundedQueueHandler(self.queue, policy=policy, timeout=timeout)
+        self.listener = BatchingQueueListener(self.queue, *self.handlers, batch_size=batch_size)
+        self._lock = threading.Lock()
+        self._started = False
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            for handler in self.handlers:
+                self.logger.removeHandler(handler)
+            self.logger.addHandler(self.handler)
+            self.listener.start()
+            self._started = True
+        return self
+
+    def stop(self):
+        """Handles all remaining records and restores the original handlers"""
+        with self._lock:
+            if not self._started:
+                return
+            self.logger.removeHandler(self.handler)
+            self.listener.stop()
+            for handler in self.handlers:
+                self.logger.addHandler(handler)
+            self._started = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, kind, value, traceback):
+        self.stop()
+
+
+def install_queue_logging(*args, **kwargs):
+    """
+    Start queue based logging, see :class:`QueueLogging` for the arguments.
+
+    :rtype: QueueLogging
+    """
+    return QueueLogging(*args, **kwargs).start()
@@ -1,8 +1,21 @@
-from queue import Queue
+from collections import namedtuple
+from concurrent.futures import Future, CancelledError
+from queue import Queue, Empty
 from threading import Thread
+import asyncio
+import inspect
+import multiprocessing
+import pickle
+import threading
+import time
 from functools import partial
 from itertools import chain
+import contextvars
+import heapq
+import itertools
+import weakref
 from .null import Null
+from .decorators import TokenBucket
 
 import logging
 logger = logging.getLogger(__name__)
@@ -16,6 +29,252 @@ class AlreadyRunningError(MultiThreadError):
     pass
 
 
+class PoolClosedError(MultiThreadError):
+    pass
+
+
+class WorkerDiedError(MultiThreadError):
+    pass
+
+
+class UnsupportedOperationError(MultiThreadError, NotImplementedError):
+    """Raised by the methods of :class:`MultiThread` a backend can't support"""
+
+
+class RunCancelledError(MultiThreadError):
+    """
+    Raised when a run was cancelled, by its :class:`CancellationToken`,
+    deadline or error threshold, with the results and failures so far.
+    """
+
+    def __init__(self, reason, results, failures):
+        super().__init__(reason)
+        self.reason = reason
+        self.results = results
+        self.failures = failures
+
+
+class Failure(namedtuple('Failure', ['args', 'exception'])):
+    """
+    An item that failed to process, with the exception. Retry the failures
+    of a run with e.g. ``t.run_with_iter(failure.item for failure in t.failures)``.
+    """
+    __slots__ = ()
+
+    @property
+    def item(self):
+        return self.args[0] if len(self.args) == 1 else self.args
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation, cancelled explicitly, after ``timeout``
+    seconds or when its ``parent`` is cancelled.
+
+    >>> run = CancellationToken()
+    >>> item = CancellationToken(timeout=60, parent=run)
+    >>> item.cancelled
+    False
+    >>> run.cancel('shutting down')
+    >>> item.cancelled, item.reason
+    (True, 'shutting down')
+    >>> CancellationToken(timeout=0).raise_if_cancelled()
+    Traceback (most recent call last):
+    ...
+    concurrent.futures._base.CancelledError: deadline exceeded
+
+    :param float timeout: seconds until the token is cancelled
+    :param CancellationToken parent: token cancelling this one
+    """
+
+    def __init__(self, timeout=None, parent=None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.parent = parent
+        self._reason = None
+
+    def cancel(self, reason=None):
+        if self._reason is None:
+            self._reason = 'cancelled' if reason is None else reason
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def reason(self):
+        """Why the token was cancelled, None while it isn't"""
+        if self._reason is None:
+            if self.expired:
+                self._reason = 'deadline exceeded'
+            elif self.parent is not None and self.parent.cancelled:
+                self._reason = self.parent.reason
+        return self._reason
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise CancelledError(self.reason)
+
+
+class PriorityFairQueue(Queue):
+    """
+    Queue of ``(priority, tag, item)`` tuples, getting the items with the
+    lowest priority first. Items with the same priority are interleaved by
+    (start-time) weighted fair queuing across their tags: every tag gets
+    its turns in proportion to its weight (1 by default), no matter how many
+    items another tag queued before.
+
+    >>> q = PriorityFairQueue(weights={'interactive': 3})
+    >>> for n in range(5):
+    ...    q.put((0, 'bulk', 'b%d' % n))
+    >>> for n in range(3):
+    ...    q.put((0, 'interactive', 'i%d' % n))
+    >>> q.put((-1, None, 'urgent'))
+    >>> [q.get() for _ in range(9)]
+    ['urgent', 'b0', 'i0', 'i1', 'i2', 'b1', 'b2', 'b3', 'b4']
+
+    :param int maxsize: maximum amount of queued items, 0 for unbounded
+    :param dict weights: weight per tag
+    :param callable cost: cost of an item for its tag, 1 by default
+    """
+
+    def __init__(self, maxsize=0, weights=None, cost=None):
+        self.weights = {} if weights is None else weights
+        self.cost = cost
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._counter = itertools.count()
+        # virtual finish time of the last queued item per tag
+        self._finish = {}
+        self._virtual_time = 0.
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        priority, tag, item = item
+        cost = 1 if self.cost is None else self.cost(item)
+        start = max(self._virtual_time, self._finish.get(tag, 0.))
+        finish = start + cost / self.weights.get(tag, 1)
+        self._finish[tag] = finish
+        heapq.heappush(self.queue, (priority, start, next(self._counter), tag, finish, item))
+
+    def _get(self):
+        priority, start, _, tag, finish, item = heapq.heappop(self.queue)
+        self._virtual_time = max(self._virtual_time, start)
+        if self._finish.get(tag) == finish:
+            # nothing queued for this tag anymore
+            del self._finish[tag]
+        return item
+
+
+def _envelope_cost(envelope):
+    return 0 if envelope is None else len(envelope[0])
+
+
+class Autoscaler:
+    """
+    Hill climbing controller for the amount of workers of a :class:`MultiThread`,
+    between ``min_workers`` and ``max_workers``.
+
+    Every ``interval`` seconds the throughput is compared to that of the
+    previous interval: the amount of workers keeps moving in the same
+    direction while the throughput improves, and reverses when it drops (or
+    when the time per item grows without improving the throughput). Without
+    queued items the amount of workers shrinks.
+
+    >>> scaler = Autoscaler(1, 4, interval=1)
+    >>> scaler.decide(workers=1, throughput=100, latency=.01, queued=10)
+    2
+    >>> scaler.decide(workers=2, throughput=190, latency=.01, queued=10)
+    3
+    >>> scaler.decide(workers=3, throughput=150, latency=.02, queued=10)
+    2
+    >>> scaler.decide(workers=2, throughput=190, latency=.01, queued=0)
+    1
+
+    :param int min_workers: minimum amount of workers
+    :param int max_workers: maximum amount of workers
+    :param float interval: seconds between decisions
+    :param float tolerance: relative change in throughput or latency regarded as noise
+    """
+
+    def __init__(self, min_workers, max_workers, interval=None, tolerance=None):
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError("Expected 1 <= min_workers <= max_workers, got %r and %r" % (min_workers, max_workers))
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = .1 if interval is None else interval
+        self.tolerance = .05 if tolerance is None else tolerance
+        self.logger = logger
+        self._lock = threading.Lock()
+        self.direction = 1
+        self._last = None
+        self.reset()
+
+    def reset(self):
+        """Start a new measurement interval, e.g. after idling between runs"""
+        self._start = time.perf_counter()
+        self._items = 0
+        self._busy = 0.
+
+    def clamp(self, workers):
+        return max(self.min_workers, min(self.max_workers, workers))
+
+    def record(self, items, elapsed, workers, queued):
+        """
+        Record ``items`` processed in ``elapsed`` seconds.
+
+        :return: the new amount of workers at the end of an interval, otherwise None
+        """
+        with self._lock:
+            self._items += items
+            self._busy += elapsed
+            duration = time.perf_counter() - self._start
+            if duration < self.interval or not self._items:
+                return None
+            throughput = self._items / duration
+            latency = self._busy / self._items
+            self.reset()
+            return self.decide(workers, throughput, latency, queued)
+
+    def decide(self, workers, throughput, latency, queued):
+        """
+        :return: the new amount of workers
+        """
+        last = self._last
+        self._last = (workers, throughput, latency)
+        if not queued:
+            reason = 'nothing queued'
+            direction = -1
+        elif last is None or last[0] == workers:
+            reason = 'probing'
+            direction = self.direction
+        elif throughput < last[1] * (1 - self.tolerance):
+            reason = 'throughput dropped'
+            direction = -self.direction
+        elif throughput <= last[1] * (1 + self.tolerance) and latency > last[2] * (1 + self.tolerance):
+            reason = 'latency grew'
+            direction = -self.direction
+        else:
+            reason = 'throughput improved'
+            direction = self.direction
+        target = self.clamp(workers + direction)
+        if target == workers and queued:
+            # bounced against a bound, probe the other way next time
+            direction = -direction
+        self.direction = direction
+        if target != workers:
+            self.logger.info('Autoscaling from %d to %d workers (%s): %.1f items/s, %.2fms per item, %d queued',
+                             workers, target, reason, throughput, latency * 1000, queued)
+        return target
+
+
 class MultiThread:
     """
     Simple wrapper class for basic multithreading
@@ -85,84 +344,1104 @@ class MultiThread:
     <lump.multithreading.MultiThread object at 0x...>
     >>> t.result
     ['before', 'after']
+
+    With ``rate_limit``, all workers together process at most ``rate_limit``
+    items per second (with bursts of up to ``burst`` items):
+
+    >>> from time import monotonic
+    >>> t = MultiThread(noop, n_workers=5, rate_limit=200, burst=1)
+    >>> t.extend(range(0, 10))
+    >>> start = monotonic()
+    >>> t.run()
+    []
+    >>> monotonic() - start >= .045
+    True
+
+    For cheap processors, items can be queued in chunks of ``chunksize``
+    items (or ``'auto'``, adapted to the measured time per item) to reduce
+    the locking overhead. With ``batch=True`` the processor gets a list of
+    items and returns a list of results:
+
+    >>> def double(items, thread_id):
+    ...    return [n * 2 for n in items]
+    >>> t = MultiThread(double, n_workers=2, chunksize=100, batch=True)
+    >>> t.extend(range(0, 1000))
+    >>> sorted(t.run()) == [n * 2 for n in range(0, 1000)]
+    True
+    >>> t = MultiThread(lambda n, thread_id: n, n_workers=2, chunksize='auto')
+    >>> sorted(t.run_with_iter(range(0, 10000))) == list(range(0, 10000))
+    True
+    >>> t.chunksize > 1
+    True
+
+    The worker threads are started on the first run and reused by the next
+    runs, until the pool is closed, garbage collected or (with
+    ``idle_timeout``) a worker was idle for ``idle_timeout`` seconds:
+
+    >>> with MultiThread(lambda n, thread_id: thread_id, n_workers=2) as t:
+    ...    first = t.run_with_iter(range(0, 10))
+    ...    threads = t.threads
+    ...    second = t.run_with_iter(range(0, 10))
+    ...    t.threads == threads
+    True
+    >>> t.threads
+    []
+    >>> t.run()
+    Traceback (most recent call last):
+    ...
+    lump.multithreading.PoolClosedError: Attempted to run a closed pool
+
+    Per worker resources, like sessions or connections, are created by the
+    ``initializer`` (called with ``initargs`` when a worker starts) and
+    passed to the processor as ``worker`` with ``pass_worker=True``. The
+    ``finalizer`` is called with them when the worker stops. When the
+    initializer raises, the items of that worker fail with its exception
+    and the run is cancelled, the next run starts a new worker:
+
+    >>> closed = []
+    >>> with MultiThread(lambda n, thread_id, worker: (thread_id, id(worker)), n_workers=2, pass_worker=True,
+    ...                  initializer=dict, finalizer=closed.append) as t:
+    ...    res = t.run_with_iter(range(0, 10))
+    >>> len(set(res)) == len(set(thread_id for thread_id, worker in res))
+    True
+    >>> len(closed) == len(set(map(id, closed))) == 2
+    True
+
+    With ``min_workers`` and/or ``max_workers``, the amount of workers
+    starts at ``n_workers`` and is adjusted while running, see
+    :class:`Autoscaler`:
+
+    >>> from time import sleep
+    >>> t = MultiThread(lambda n, thread_id: sleep(.001), n_workers=1, max_workers=8)
+    >>> t.run_with_iter(range(0, 10))
+    []
+    >>> 1 <= t.n_workers <= 8
+    True
+
+    With ``scheduling='priority'`` items are queued in a
+    :class:`PriorityFairQueue`: ``append``, ``extend`` and ``submit`` take
+    a ``priority`` (lowest first) and a ``tag``, and tags with the same
+    priority share the workers according to their ``weights``. Use
+    :meth:`submit` to process items on the workers of a pool, next to or
+    between runs:
+
+    >>> t = MultiThread(lambda n, thread_id: n * 2, n_workers=2, scheduling='priority', weights={'api': 10})
+    >>> t.submit(21, priority=-1, tag='api').result()
+    42
+
+    Failed items are kept in ``failures`` as :class:`Failure` (and returned
+    with the results with ``return_failures=True``). A run is cancelled,
+    raising :class:`RunCancelledError` with the results so far, when its
+    ``token`` is cancelled, after ``timeout`` seconds or when ``max_errors``
+    items failed; the queued items are skipped and kept in ``failures`` to
+    retry them. Threads can't be interrupted, so ``item_timeout`` only fails
+    the items that took longer, processors can stop early by checking the
+    :class:`CancellationToken` passed as ``token`` with ``pass_token=True``:
+
+    >>> t = MultiThread(lambda n, thread_id: 1 // n, n_workers=1, max_errors=1)
+    >>> t.run_with_iter([1, 0, 2, 3])
+    Traceback (most recent call last):
+    ...
+    lump.multithreading.RunCancelledError: 1 errors
+    >>> t.failures[0]
+    Failure(args=(0,), exception=ZeroDivisionError('integer division or modulo by zero'))
     """
-    def __init__(self, processor=None, n_workers=5, queue_buffer_size=None, pbar=None, pass_thread_id=True):
+    # with chunksize='auto', chunks are sized to take about this many seconds to process
+    chunk_duration = .005
+    max_chunksize = 1000
+    # seconds between checks whether the run was cancelled while waiting to feed more items
+    poll_interval = .1
+
+    def __init__(self, processor=None, n_workers=5, queue_buffer_size=None, pbar=None, pass_thread_id=True,
+                 rate_limit=None, burst=None, feed_buffer_size=None, chunksize=None, batch=False,
+                 idle_timeout=None, initializer=None, initargs=(), finalizer=None, pass_worker=False,
+                 min_workers=None, max_workers=None, scheduling=None, weights=None, token=None, timeout=None,
+                 item_timeout=None, max_errors=None, pass_token=False, return_failures=False):
         self.processor = processor
         if queue_buffer_size is None:
             queue_buffer_size = 0
-        self.q = Queue(maxsize=queue_buffer_size)
+        if scheduling is None or scheduling == 'fifo':
+            self.q = Queue(maxsize=queue_buffer_size)
+        elif scheduling == 'priority':
+            self.q = PriorityFairQueue(maxsize=queue_buffer_size, weights=weights, cost=_envelope_cost)
+        else:
+            raise ValueError("Unknown scheduling %r, expected 'fifo' or 'priority'" % (scheduling,))
+        self.scheduling = scheduling
+        self.autoscaler = None
+        if min_workers is not None or max_workers is not None:
+            min_workers = 1 if min_workers is None else min_workers
+            max_workers = max(n_workers, min_workers) if max_workers is None else max_workers
+            self.autoscaler = Autoscaler(min_workers, max_workers)
+            n_workers = self.autoscaler.clamp(n_workers)
         self.n_workers = n_workers
         self.pbar = pbar
         self.logger = logger
         self.result = None
         self.pass_thread_id = pass_thread_id
+        if rate_limit is not None and not isinstance(rate_limit, TokenBucket):
+            rate_limit = TokenBucket(rate_limit, burst)
+        self.rate_limiter = rate_limit
+        # when streaming results (see imap), (sequence number, result) is put on this queue
+        self._out = None
+        # maximum amount of chunks of an iterable queued at once by run_with_iter
+        max_workers = n_workers if self.autoscaler is None else self.autoscaler.max_workers
+        self.feed_buffer_size = 2 * max_workers if feed_buffer_size is None else feed_buffer_size
+        self.adaptive_chunksize = chunksize == 'auto'
+        self.chunksize = 1 if chunksize is None or self.adaptive_chunksize else chunksize
+        self.batch = batch
+        self._chunk = []
+        self._chunk_key = (0, None)
+        # (envelope, priority, tag) of the items appended while no run is active, queued by the next run
+        self._held = []
+        # seconds before an idle worker thread stops, None to keep the workers until the pool is closed
+        self.idle_timeout = idle_timeout
+        self._threads = []
+        # workers whose initializer failed, replaced by the next run
+        self._broken = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        # (args, kwargs, context) of the current run, workers rebuild their processor when it changes
+        self._run = None
+        self.initializer = initializer
+        self.initargs = initargs
+        self.finalizer = finalizer
+        self.pass_worker = pass_worker
+        # cancels all runs when cancelled
+        self.token = token
+        # seconds per run and per item
+        self.timeout = timeout
+        self.item_timeout = item_timeout
+        # amount of failed items cancelling a run, 1 to fail fast
+        self.max_errors = max_errors
+        self.pass_token = pass_token
+        self.return_failures = return_failures
+        self.failures = []
+        # cancellation token of the current run
+        self._token = None
 
-    def _worker(self, *args, **kwargs):
-        self.logger.info('Worker started')
-        processor = partial(self.processor, *args, **kwargs)
-        while True:
-            args = self.q.get()
-            result = None
-            try:
+    def _call(self, processor, args, token):
+        """
+        :return: the result, or a :class:`Failure`
+        """
+        item_token = token
+        if self.item_timeout is not None:
+            item_token = CancellationToken(self.item_timeout, token)
+        try:
+            if self.pass_token:
+                result = processor(*args, token=item_token)
+            else:
                 result = processor(*args)
-            except Exception as e:
-                if self.logger:
-                    self.logger.exception(e)
+        except Exception as e:
+            if self.logger:
+                self.logger.exception(e)
+            return Failure(args, e)
+        if item_token is not token and item_token.expired:
+            return Failure(args, TimeoutError("Processing took longer than %ss" % (self.item_timeout,)))
+        return result
 
-            if result is not None:
-                self.result.append(result)
-            self.q.task_done()
-            if self.pbar is not None:
-                self.pbar.update(1)
+    def _process(self, processor, chunk, token=None):
+        """
+        :return: list of results (:class:`Failure` for failed items), or a single result for a chunk of one item
+        """
+        rate_limiter = self.rate_limiter
+        if self.batch:
+            if rate_limiter is not None:
+                rate_limiter.acquire(len(chunk))
+            # with item_timeout, the whole batch is timed
+            results = self._call(processor, ([args[0] if len(args) == 1 else args for args in chunk],), token)
+            if isinstance(results, Failure):
+                return [Failure(args, results.exception) for args in chunk]
+            return results or []
+
+        results = []
+        for args in chunk:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            results.append(self._call(processor, args, token))
+        return results
+
+    def _adapt_chunksize(self, chunk_size, elapsed):
+        per_item = elapsed / chunk_size
+        if per_item <= 0:
+            chunksize = self.max_chunksize
+        else:
+            chunksize = int(self.chunk_duration / per_item)
+        # move halfway to the new size, to dampen noisy measurements
+        self.chunksize = max(1, min(self.max_chunksize, (self.chunksize + chunksize) // 2))
+
+    def _worker_processor(self, slot, worker):
+        args, kwargs, context = self._run
+        if self.pass_thread_id:
+            kwargs = dict(kwargs, thread_id=slot)
+        if self.pass_worker:
+            kwargs = dict(kwargs, worker=worker)
+        return partial(self.processor, *args, **kwargs), context.copy()
+
+    def _handle(self, processor, context, chunk, seq, release, token, error=None):
+        """
+        :param Exception error: fail the items with this error instead of processing them
+        """
+        # the lists of the run the chunk belongs to, a timed out run doesn't get later results
+        result_list, failure_list = self.result, self.failures
+        if token is None and not isinstance(seq, Future):
+            # appended before the run started
+            token = self._token
+        if isinstance(seq, Future):
+            if not seq.set_running_or_notify_cancel():
+                pass
+            elif error is not None:
+                seq.set_exception(error)
+            else:
+                result = context.run(self._process, processor, chunk)[0]
+                if isinstance(result, Failure):
+                    seq.set_exception(result.exception)
+                else:
+                    seq.set_result(result)
+            results = []
+        elif error is not None:
+            results = [Failure(args, error) for args in chunk]
+            failure_list.extend(results)
+            if token is not None:
+                token.cancel('worker initializer failed: %r' % (error,))
+        elif token is not None and token.cancelled:
+            # skip the queued items of a cancelled run
+            results = [Failure(args, CancelledError(token.reason)) for args in chunk]
+            if token is self._token:
+                failure_list.extend(results)
+        else:
+            start = time.perf_counter()
+            results = context.run(self._process, processor, chunk, token)
+            elapsed = time.perf_counter() - start
+            if self.adaptive_chunksize:
+                self._adapt_chunksize(len(chunk), elapsed)
+            if self.autoscaler is not None:
+                n_workers = self.autoscaler.record(len(chunk), elapsed, self.n_workers, self.q.qsize())
+                if n_workers is not None:
+                    self._scale(n_workers)
+            failures = [result for result in results if isinstance(result, Failure)]
+            if failures:
+                failure_list.extend(failures)
+                if self.max_errors is not None and token is not None and len(failure_list) >= self.max_errors:
+                    token.cancel('%d errors' % (len(failure_list),))
+
+        if not self.return_failures:
+            results = [None if isinstance(result, Failure) else result for result in results]
+        if self._out is not None and seq is not None and not isinstance(seq, Future):
+            for i, result in enumerate(results):
+                self._out.put((seq + i, result))
+        elif result_list is not None:
+            result_list.extend(result for result in results if result is not None)
+        self.q.task_done()
+        if release is not None:
+            release()
+        if self.pbar is not None:
+            self.pbar.update(len(chunk))
 
-    def append(self, *args):
+    def _retire(self, slot):
+        """
+        :return: whether the idle worker in ``slot`` may stop
+        """
+        with self._lock:
+            if self.running or not self.q.empty():
+                return False
+            if self._threads[slot] is threading.current_thread():
+                self._threads[slot] = None
+            self.logger.debug('Worker %d stopped after idling', slot)
+            return True
+
+    def _retire_surplus(self, slot):
+        """
+        :return: whether the worker in ``slot`` may stop after scaling down
+        """
+        with self._lock:
+            if slot < self.n_workers:
+                return False
+            self._threads[slot] = None
+            return True
+
+    def _spawn(self):
+        self._threads.extend([None] * (self.n_workers - len(self._threads)))
+        for slot in range(self.n_workers):
+            thread = self._threads[slot]
+            if thread is None or not thread.is_alive() or thread in self._broken:
+                thread = Thread(target=_pool_worker, args=(weakref.ref(self), self.q, slot, self.idle_timeout),
+                                daemon=True)
+                thread.start()
+                self._threads[slot] = thread
+
+    def _scale(self, n_workers):
+        with self._lock:
+            if self._closed:
+                return
+            self.n_workers = n_workers
+            self._spawn()
+
+    @property
+    def threads(self):
+        """The currently running worker threads"""
+        return [thread for thread in self._threads if thread is not None and thread.is_alive()]
+
+    def _put(self, envelope, priority=0, tag=None, block=True):
+        if self.scheduling == 'priority':
+            envelope = (priority, tag, envelope)
+        self.q.put(envelope, block)
+
+    def _queue(self, envelope, priority=0, tag=None):
+        if not self.running:
+            # idle workers of the previous run would process them with its arguments, and drop the results
+            self._held.append((envelope, priority, tag))
+            return
+        self._put(envelope, priority, tag)
+
+    def _flush(self):
+        chunk, self._chunk = self._chunk, []
+        if chunk:
+            priority, tag = self._chunk_key
+            self._queue((chunk, None, None, None), priority, tag)
+
+    def append(self, *args, priority=0, tag=None):
         # self.logger.debug('Append 1 item to queue')
-        self.q.put(args)
+        if self.chunksize == 1:
+            self._queue(([args], None, None, None), priority, tag)
+            return
+        if (priority, tag) != self._chunk_key:
+            self._flush()
+            self._chunk_key = (priority, tag)
+        self._chunk.append(args)
+        if len(self._chunk) >= self.chunksize:
+            self._flush()
 
-    def extend(self, iterable):
+    def extend(self, iterable, priority=0, tag=None):
         for row in iterable:
-            self.append(row)
+            self.append(row, priority=priority, tag=tag)
+
+    def submit(self, *args, priority=0, tag=None):
+        """
+        Queue a single item, starting the workers when needed. Items are
+        processed with the arguments of the current run (if any), their
+        results aren't part of the results of the run.
+
+        :param int priority: lower priorities are processed first, with ``scheduling='priority'``
+        :param tag: submitter of the item, for fair queuing with ``scheduling='priority'``
+        :return: future for the result of processing the item
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise PoolClosedError("Attempted to submit to a closed pool")
+            if self._run is None:
+                self._run = ((), {}, contextvars.copy_context())
+            self._spawn()
+        self._put(([args], future, None, None), priority, tag)
+        return future
 
     def wait(self):
-        self.q.join()
+        self._flush()
+        token = self._token
+        if token is None or token.deadline is None:
+            self.q.join()
+            return self
+        with self.q.all_tasks_done:
+            while self.q.unfinished_tasks:
+                remaining = token.deadline - time.monotonic()
+                if remaining <= 0:
+                    # don't wait for items that are still processing, their results are dropped
+                    token.cancel('deadline exceeded')
+                    break
+                self.q.all_tasks_done.wait(remaining)
         return self
 
+    def cancel(self, reason=None):
+        """Cancel the current run, see :class:`CancellationToken`"""
+        if self._token is not None:
+            self._token.cancel(reason)
+
     def start(self, *args, **kwargs):
-        if self.running:
-            raise AlreadyRunningError("Attempted to run while already running")
-        self.result = []
-        self.logger.debug('Starting threaded run, %d workers', self.n_workers)
-        for i in range(self.n_workers):
-            if self.pass_thread_id:
-                kwargs['thread_id'] = i
-            t = Thread(target=partial(self._worker, *args, **kwargs), daemon=True)
-            t.start()
+        with self._lock:
+            if self.running:
+                raise AlreadyRunningError("Attempted to run while already running")
+            if self._closed:
+                raise PoolClosedError("Attempted to run a closed pool")
+            self.result = []
+            self.failures = []
+            self._token = CancellationToken(self.timeout, self.token)
+            # process in a copy of the current context, so e.g. timeit spans nest across threads
+            self._run = (args, kwargs, contextvars.copy_context())
+            self.logger.debug('Starting threaded run, %d workers', self.n_workers)
+            if self.autoscaler is not None:
+                self.autoscaler.reset()
+            self._spawn()
+            held, self._held = self._held, []
+        for envelope, priority, tag in held:
+            self._put(envelope, priority, tag)
+
+    def close(self):
+        """Stop the worker threads, after the queued items are processed"""
+        with self._lock:
+            self._closed = True
+            self._flush()
+            for _ in self.threads:
+                self._put(None, float('inf'))
+
+    def join(self, timeout=None):
+        """Wait for the worker threads to stop, call :meth:`close` first"""
+        for thread in self.threads:
+            thread.join(timeout)
+        self._threads = [thread for thread in self._threads if thread is not None and thread.is_alive()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+        self.join()
+
+    def __del__(self):
+        # the workers only hold a weak reference to the pool while idle, so stop them with it
+        try:
+            for _ in self.threads:
+                self._put(None, float('inf'), block=False)
+        except Exception:
+            pass
 
     @property
     def running(self):
         return self.result is not None
 
-    def run_with_iter(self, iterable, *args, **kwargs):
-        self.logger.debug('run')
-        self.start(*args, **kwargs)
-        self.logger.debug('started, add iterable')
-        self.extend(iterable)
-        self.logger.debug('waiting to finish')
-        self.wait()
+    def _finish(self):
         result = self.result
         self.result = None
         self.logger.debug('Threaded run done, %d results', len(result))
         return result
 
+    def _abort(self):
+        """Stop the current run, skipping its queued items"""
+        self.cancel('aborted')
+        self._chunk = []
+        self.q.join()
+        with self._lock:
+            self.result = None
+            self._run = None
+
+    def _results(self):
+        """
+        :return: the results of the run
+        :raises RunCancelledError: when the run was cancelled
+        """
+        result = self._finish()
+        token = self._token
+        if token is not None and token.cancelled:
+            self.logger.warning('Run cancelled: %s, %d failures', token.reason, len(self.failures))
+            raise RunCancelledError(token.reason, result, self.failures)
+        return result
+
+    def _acquire(self, slots, token):
+        """
+        Wait for one of the ``slots``, until ``token`` is cancelled or its deadline passed
+
+        :return: whether a slot was acquired
+        """
+        if token is None:
+            return slots.acquire()
+        while not token.cancelled:
+            timeout = self.poll_interval
+            if token.deadline is not None:
+                timeout = max(0, min(timeout, token.deadline - time.monotonic()))
+            if slots.acquire(timeout=timeout):
+                return True
+        return False
+
+    def _feed(self, iterable):
+        """Lazily queue the iterable, with at most ``feed_buffer_size`` chunks waiting at once"""
+        slots = threading.BoundedSemaphore(self.feed_buffer_size)
+        chunk = []
+        token = self._token
+        for row in iterable:
+            if token is not None and token.cancelled:
+                break
+            chunk.append((row,))
+            if len(chunk) >= self.chunksize:
+                if not self._acquire(slots, token):
+                    break
+                self._put((chunk, None, slots.release, token))
+                chunk = []
+        else:
+            if chunk and self._acquire(slots, token):
+                self._put((chunk, None, slots.release, token))
+
+    def run_with_iter(self, iterable, *args, **kwargs):
+        """
+        Start the workers and feed them the iterable while they're running,
+        so memory depends on ``feed_buffer_size`` instead of the input size.
+
+        >>> consumed = []
+        >>> def items():
+        ...    for n in range(100):
+        ...        consumed.append(n)
+        ...        yield n
+        >>> def proc(n, thread_id):
+        ...    return len(consumed) - n
+        >>> t = MultiThread(proc, n_workers=2, feed_buffer_size=4)
+        >>> max(t.run_with_iter(items())) <= 4 + 1
+        True
+        """
+        self.logger.debug('run')
+        self.start(*args, **kwargs)
+        try:
+            self.logger.debug('started, add iterable')
+            self._feed(iterable)
+            self.logger.debug('waiting to finish')
+            self.wait()
+        except BaseException:
+            # e.g. the iterable raised, don't leave the pool running
+            self._abort()
+            raise
+        return self._results()
+
     def run(self, *args, **kwargs) -> list:
         self.logger.debug('run')
         self.start(*args, **kwargs)
-        self.logger.debug('started, waiting now')
-        self.wait()
-        result = self.result
+        try:
+            self.logger.debug('started, waiting now')
+            self.wait()
+        except BaseException:
+            self._abort()
+            raise
+        return self._results()
+
+    def imap(self, iterable, *args, ordered=False, buffer_size=None, **kwargs):
+        """
+        Process the iterable, yielding the (non-None) results as soon as they
+        are available, in completion order or in input order if ``ordered``.
+
+        At most ``buffer_size`` (default ``feed_buffer_size``) items are queued,
+        processing or waiting to be yielded, so workers pause when the
+        consumer falls behind and memory doesn't grow with the input size.
+
+        >>> from time import sleep
+        >>> def proc(n, thread_id):
+        ...    sleep((10 - n) / 1000)
+        ...    return n
+        >>> t = MultiThread(proc, n_workers=4)
+        >>> list(t.imap(range(10), ordered=True))
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+        >>> sorted(t.imap(range(10)))
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+        >>> for n in t.imap(range(1000000)):
+        ...    break
+        >>> t.running
+        False
+        """
+        if buffer_size is None:
+            buffer_size = self.feed_buffer_size
+        out = Queue()
+        slots = threading.Semaphore(buffer_size)
+        end = object()
+        stopped = threading.Event()
+        # exception raised by the iterable, re-raised by the generator after the preceding results
+        feed_errors = []
+
+        def _feed():
+            n = 0
+            try:
+                for row in iterable:
+                    slots.acquire()
+                    if stopped.is_set() or (self._token is not None and self._token.cancelled):
+                        break
+                    self._submit([(row,)], n)
+                    n += 1
+            except BaseException as e:
+                feed_errors.append(e)
+            finally:
+                # e.g. stop the previous stage of a Pipeline
+                close = getattr(iterable, 'close', None)
+                if close is not None:
+                    close()
+                out.put((end, n))
+
+        self._out = out
+        self.start(*args, **kwargs)
+        feeder = Thread(target=_feed, daemon=True)
+        feeder.start()
+
+        total = None
+        received = 0
+        next_seq = 0
+        reorder_buffer = {}
+        try:
+            while total is None or received < total:
+                seq, result = out.get()
+                if seq is end:
+                    total = result
+                    continue
+                received += 1
+                if not ordered:
+                    slots.release()
+                    if result is not None:
+                        yield result
+                    continue
+                reorder_buffer[seq] = result
+                while next_seq in reorder_buffer:
+                    result = reorder_buffer.pop(next_seq)
+                    next_seq += 1
+                    slots.release()
+                    if result is not None:
+                        yield result
+            if feed_errors:
+                raise feed_errors[0]
+            if self._token is not None and self._token.cancelled:
+                raise RunCancelledError(self._token.reason, [], self.failures)
+        finally:
+            # stop feeding and let the workers finish the already queued items
+            stopped.set()
+            slots.release()
+            feeder.join()
+            self.wait()
+            self._finish()
+            self._out = None
+
+    def _submit(self, chunk, seq):
+        """Queue a chunk of items for :meth:`imap`, its results are put on ``_out`` from ``seq`` on"""
+        self._put((chunk, seq, None, self._token))
+
+
+def _pool_worker(ref, q, slot, idle_timeout):
+    """Worker thread of a :class:`MultiThread` pool, only holding a weak reference to the pool while idle"""
+    logger.info('Worker started')
+    pool = ref()
+    finalizer = pool.finalizer
+    try:
+        worker = _start_worker(pool.initializer, pool.initargs)
+    except Exception as e:
+        logger.exception(e)
+        # fail the items this worker gets (cancelling their run) until the pool is idle, so the initializer
+        # is retried by a new worker for the next run
+        _broken_worker(ref, q, slot, e)
+        return
+    del pool
+    run = processor = context = None
+    try:
+        while True:
+            try:
+                envelope = q.get(timeout=idle_timeout)
+            except Empty:
+                pool = ref()
+                if pool is None or pool._retire(slot):
+                    return
+                del pool
+                continue
+            pool = ref()
+            if envelope is None or pool is None:
+                q.task_done()
+                return
+            if pool._run is not run:
+                run = pool._run
+                processor, context = pool._worker_processor(slot, worker)
+            pool._handle(processor, context, *envelope)
+            if slot >= pool.n_workers and pool._retire_surplus(slot):
+                return
+            del pool
+    finally:
+        _stop_worker(finalizer, worker)
+
+
+def _broken_worker(ref, q, slot, error):
+    """Worker thread whose initializer failed with ``error``, until it's replaced by the next run"""
+    current = threading.current_thread()
+    pool = ref()
+    pool._broken.add(current)
+    del pool
+    try:
+        while True:
+            try:
+                envelope = q.get(timeout=.1)
+            except Empty:
+                envelope = False
+            pool = ref()
+            if envelope is None or pool is None:
+                if envelope is not False:
+                    q.task_done()
+                return
+            replaced = pool._threads[slot] is not current
+            if envelope is not False:
+                if replaced:
+                    # leave it to the new worker
+                    pool._put(envelope)
+                    q.task_done()
+                else:
+                    pool._handle(None, None, *envelope, error=error)
+            if replaced or pool._retire(slot):
+                return
+            del pool
+    finally:
+        pool = ref()
+        if pool is not None:
+            pool._broken.discard(current)
+
+
+def _start_worker(initializer, initargs):
+    """
+    :return: the per worker resources created by the initializer
+    """
+    if initializer is None:
+        return None
+    return initializer(*initargs)
+
+
+def _stop_worker(finalizer, worker):
+    if finalizer is None:
+        return
+    try:
+        finalizer(worker)
+    except Exception as e:
+        logger.exception(e)
+
+
+def _process_worker(processor, in_q, out_q, initializer, initargs, finalizer, pass_worker, args, kwargs):
+    worker = _start_worker(initializer, initargs)
+    if pass_worker:
+        kwargs['worker'] = worker
+    processor = partial(processor, *args, **kwargs)
+    try:
+        while True:
+            message = in_q.get()
+            if message is None:
+                return
+            seq, chunk = message
+            results = []
+            for item in chunk:
+                try:
+                    # pickle here, a result that can't be pickled would otherwise be lost by the queue
+                    results.append(pickle.dumps(processor(*item), pickle.HIGHEST_PROTOCOL))
+                except Exception as e:
+                    logger.exception(e)
+                    results.append(None)
+            out_q.put((seq, results))
+    finally:
+        _stop_worker(finalizer, worker)
+
+
+class MultiProcess(MultiThread):
+    """
+    Same as :class:`MultiThread`, but processing in ``n_workers`` processes
+    (each with their own ``thread_id``), for CPU-bound processors.
+
+    Items are sent to the workers in pickled chunks of ``chunksize`` items.
+    Where available the processes are forked, so the processor doesn't need
+    to be picklable, items and results always do. Forking a process that runs
+    other threads (e.g. the workers of a :class:`MultiThread` pool, or the
+    thread stages of a :class:`Pipeline`) may leave locks held in the child
+    forever, so a warning is logged then: prefer ``start_method='forkserver'``
+    (or ``'spawn'``) there, with a processor, initializer and finalizer that
+    can be pickled, i.e. defined at module level (and not decorated with
+    :func:`multiprocessed`).
+
+    The processes only live for a run, so :meth:`submit` raises
+    :class:`UnsupportedOperationError`. Items are processed in order (the
+    ``priority`` and ``tag`` of ``append`` are ignored), and the adaptive
+    chunksize and cancellation options of :class:`MultiThread` aren't
+    supported.
+
+    >>> def square(n, thread_id):
+    ...    return n * n, thread_id
+    >>> t = MultiProcess(square, n_workers=2, chunksize=5)
+    >>> t.extend(range(0, 100))
+    >>> res = t.run()
+    >>> sorted(n for n, thread_id in res) == [n * n for n in range(0, 100)]
+    True
+    >>> set(thread_id for n, thread_id in res) <= {0, 1}
+    True
+    >>> t.run_with_iter(range(0, 3))  # doctest: +ELLIPSIS
+    [...]
+    >>> [n for n, thread_id in t.imap(range(0, 5), ordered=True)]
+    [0, 1, 4, 9, 16]
+
+    :param int chunksize: amount of items sent to a worker at once
+    :param callable initializer: called once in each worker process with ``initargs``
+    :param tuple initargs: arguments for the initializer
+    :param callable finalizer: called with the result of the initializer when a worker process stops
+    :param bool pass_worker: pass the result of the initializer to the processor as ``worker``
+    :param str start_method: multiprocessing start method, ``fork`` where available
+    :raises WorkerDiedError: from the run when a worker process exits unexpectedly, e.g. when it's killed
+    """
+    # seconds between checks whether the worker processes are still alive while waiting
+    poll_interval = .1
+
+    def __init__(self, processor=None, n_workers=None, queue_buffer_size=None, pbar=None, pass_thread_id=True,
+                 rate_limit=None, burst=None, chunksize=None, initializer=None, initargs=(), start_method=None,
+                 finalizer=None, pass_worker=False):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        if chunksize == 'auto':
+            raise ValueError("Adaptive chunksize is not supported by %s" % (type(self).__name__,))
+        super().__init__(processor, n_workers, queue_buffer_size, pbar, pass_thread_id, rate_limit, burst,
+                         chunksize=chunksize, initializer=initializer, initargs=initargs, finalizer=finalizer,
+                         pass_worker=pass_worker)
+        if start_method is None and 'fork' in multiprocessing.get_all_start_methods():
+            start_method = 'fork'
+        self.context = multiprocessing.get_context(start_method)
+        self.queue_buffer_size = queue_buffer_size
+        self._in_q = None
+        self._out_q = None
+        self._pending = 0
+        self._pending_lock = threading.Condition()
+        self._processes = []
+        self._collector = None
+        self._fork_warned = False
+
+    def _warn_fork(self):
+        if self._fork_warned or self.context.get_start_method() != 'fork':
+            return
+        # the feeder threads of multiprocessing queues are reset in the child
+        threads = [thread.name for thread in threading.enumerate()
+                   if thread is not threading.current_thread() and thread.name != 'QueueFeederThread']
+        if threads:
+            self._fork_warned = True
+            self.logger.warning("Forking worker processes while %d other threads are running (%s), which may "
+                                "deadlock them, consider start_method='forkserver'",
+                                len(threads), ', '.join(threads[:5]))
+
+    def _queues(self):
+        if self._in_q is None:
+            self._in_q = self.context.Queue(maxsize=self.queue_buffer_size or 0)
+            self._out_q = self.context.Queue()
+        return self._in_q, self._out_q
+
+    def _flush(self):
+        chunk, self._chunk = self._chunk, []
+        if chunk:
+            self._submit(chunk, None)
+
+    def _submit(self, chunk, seq):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(len(chunk))
+        with self._pending_lock:
+            self._pending += len(chunk)
+        self._queues()[0].put((seq, chunk))
+
+    def _collect(self, out_q, result):
+        while True:
+            message = out_q.get()
+            if message is None:
+                return
+            seq, results = message
+            results = [None if result is None else pickle.loads(result) for result in results]
+            if self._out is not None:
+                for i, item_result in enumerate(results):
+                    self._out.put((seq + i, item_result))
+            else:
+                result.extend(item_result for item_result in results if item_result is not None)
+            if self.pbar is not None:
+                self.pbar.update(len(results))
+            with self._pending_lock:
+                self._pending -= len(results)
+                self._pending_lock.notify_all()
+
+    def _feed(self, iterable):
+        """Lazily queue the iterable, with at most ``feed_buffer_size`` chunks queued or processing at once"""
+        limit = (self.feed_buffer_size - 1) * self.chunksize
+        for row in iterable:
+            self.append(row)
+            self._wait_pending(limit)
+
+    def _wait_pending(self, limit):
+        """
+        Wait until at most ``limit`` items are queued or processing
+
+        :raises WorkerDiedError: when a worker process stopped unexpectedly
+        """
+        with self._pending_lock:
+            while self._pending > limit:
+                if self._pending_lock.wait(self.poll_interval):
+                    continue
+                dead = [process for process in self._processes if not process.is_alive()]
+                if dead:
+                    raise WorkerDiedError("Worker process %d exited with %s, %d items unprocessed" % (
+                        dead[0].pid, dead[0].exitcode, self._pending))
+
+    def append(self, *args, priority=0, tag=None):
+        # items are processed in order, priority scheduling is not supported
+        self._chunk.append(args)
+        if len(self._chunk) >= self.chunksize:
+            self._flush()
+
+    def submit(self, *args, **kwargs):
+        raise UnsupportedOperationError("submit is not supported by %s" % (type(self).__name__,))
+
+    def wait(self):
+        self._flush()
+        self._wait_pending(0)
+        return self
+
+    def start(self, *args, **kwargs):
+        if self.running:
+            raise AlreadyRunningError("Attempted to run while already running")
+        self.result = []
+        in_q, out_q = self._queues()
+        self.logger.debug('Starting multiprocess run, %d workers', self.n_workers)
+        self._warn_fork()
+        for i in range(self.n_workers):
+            if self.pass_thread_id:
+                kwargs['thread_id'] = i
+            process = self.context.Process(target=_process_worker, daemon=True, args=(
+                self.processor, in_q, out_q, self.initializer, self.initargs, self.finalizer, self.pass_worker,
+                args, dict(kwargs)))
+            process.start()
+            self._processes.append(process)
+        self._collector = Thread(target=self._collect, args=(out_q, self.result), daemon=True)
+        self._collector.start()
+
+    def _abort(self):
+        """Stop the worker processes without processing the queued items"""
+        self._chunk = []
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+        if self._collector is not None:
+            self._out_q.put(None)
+            self._collector.join(1)
+        # terminated processes may have left the queues unusable, and nothing reads what's left on them, so
+        # don't wait for their feeder threads to flush at exit
+        for q in (self._in_q, self._out_q):
+            if q is not None:
+                q.cancel_join_thread()
+                q.close()
+        self._in_q = self._out_q = None
+        self._processes = []
+        self._collector = None
+        self._pending = 0
         self.result = None
-        self.logger.debug('Threaded run done, %d results', len(result))
-        return result
+
+    def close(self):
+        """Stop the worker processes, after the queued items are processed"""
+        if not self._processes:
+            return
+        self._flush()
+        in_q, out_q = self._queues()
+        for _ in self._processes:
+            in_q.put(None)
+        for process in self._processes:
+            process.join()
+        out_q.put(None)
+        self._collector.join()
+        self._processes = []
+        self._collector = None
+
+    def _finish(self):
+        self.close()
+        return super()._finish()
+
+
+class MultiAsync(MultiThread):
+    """
+    Same as :class:`MultiThread`, but processing in ``n_workers`` asyncio tasks
+    (each with their own ``thread_id``), for (coroutine) I/O-bound processors.
+
+    ``run`` and ``run_with_iter`` run their own event loop when called from
+    sync code, and return an awaitable when called from a running event loop.
+    The tasks only live for a run, so ``start``, ``wait``, ``imap`` and
+    ``submit`` raise :class:`UnsupportedOperationError`.
+
+    >>> import asyncio
+    >>> async def fetch(n, thread_id):
+    ...    await asyncio.sleep(.01)
+    ...    return n, thread_id
+    >>> t = MultiAsync(fetch, n_workers=100)
+    >>> t.extend(range(0, 1000))
+    >>> res = t.run()
+    >>> sorted(n for n, thread_id in res) == list(range(0, 1000))
+    True
+    >>> set(thread_id for n, thread_id in res) == set(range(0, 100))
+    True
+    >>> async def main():
+    ...    return await t.run_with_iter(range(0, 3))
+    >>> sorted(asyncio.run(main()))
+    [(0, 0), (1, 1), (2, 2)]
+    """
+
+    def __init__(self, processor=None, n_workers=5, queue_buffer_size=None, pbar=None, pass_thread_id=True,
+                 rate_limit=None, burst=None):
+        super().__init__(processor, n_workers, queue_buffer_size, pbar, pass_thread_id, rate_limit, burst)
+        self._items = []
+
+    @staticmethod
+    def _in_event_loop():
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    def append(self, *args, priority=0, tag=None):
+        # items are processed in order, priority scheduling is not supported
+        self._items.append(args)
+
+    def start(self, *args, **kwargs):
+        raise UnsupportedOperationError("Use run or run_with_iter for %s" % (type(self).__name__,))
+
+    def imap(self, *args, **kwargs):
+        raise UnsupportedOperationError("imap is not supported by %s" % (type(self).__name__,))
+
+    def submit(self, *args, **kwargs):
+        raise UnsupportedOperationError("submit is not supported by %s" % (type(self).__name__,))
+
+    def wait(self):
+        raise UnsupportedOperationError("Use run or run_with_iter for %s" % (type(self).__name__,))
+
+    async def _worker(self, items, *args, **kwargs):
+        processor = partial(self.processor, *args, **kwargs)
+        for item in items:
+            if self.rate_limiter is not None:
+                while not self.rate_limiter.acquire(blocking=False):
+                    await asyncio.sleep(1 / self.rate_limiter.rate)
+            try:
+                result = processor(*item)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                self.logger.exception(e)
+                result = None
+
+            if result is not None:
+                self.result.append(result)
+            if self.pbar is not None:
+                self.pbar.update(1)
+
+    async def _arun(self, items, *args, **kwargs):
+        if self.running:
+            raise AlreadyRunningError("Attempted to run while already running")
+        self.result = []
+        self.logger.debug('Starting async run, %d workers', self.n_workers)
+        # all workers share the same iterator, so each item is processed once
+        items = iter(items)
+        workers = []
+        for i in range(self.n_workers):
+            if self.pass_thread_id:
+                kwargs['thread_id'] = i
+            workers.append(self._worker(items, *args, **kwargs))
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            self.result = None
+            raise
+        return self._finish()
+
+    async def arun_with_iter(self, iterable, *args, **kwargs):
+        return await self._arun(((row,) for row in iterable), *args, **kwargs)
+
+    async def arun(self, *args, **kwargs):
+        items, self._items = self._items, []
+        return await self._arun(items, *args, **kwargs)
+
+    def run_with_iter(self, iterable, *args, **kwargs):
+        coroutine = self.arun_with_iter(iterable, *args, **kwargs)
+        return coroutine if self._in_event_loop() else asyncio.run(coroutine)
+
+    def run(self, *args, **kwargs):
+        coroutine = self.arun(*args, **kwargs)
+        return coroutine if self._in_event_loop() else asyncio.run(coroutine)
 
 
 def singlethreaded(*args, pass_thread_id=True, class_method_with_self=False, pre_start=False, pbar=None, **kwargs):
@@ -266,7 +1545,83 @@ def singlethreaded(*args, pass_thread_id=True, class_method_with_self=False, pre
 singlethreadedmethod = partial(singlethreaded, class_method_with_self=True)
 
 
-def multithreaded(*args, class_method_with_self=False, pre_start=False, **kwargs):
+def _executor(backend, *args, **kwargs):
+    if backend is None or backend == 'thread':
+        return MultiThread(*args, **kwargs)
+    if backend == 'process':
+        return MultiProcess(*args, **kwargs)
+    if backend == 'async':
+        return MultiAsync(*args, **kwargs)
+    raise ValueError("Unknown backend %r, expected 'thread', 'process' or 'async'" % (backend,))
+
+
+class Pipeline:
+    """
+    Chain of stages, each processing the results of the previous stage with
+    their own workers. Items stream through the stages, which run at the
+    same time, with at most ``buffer_size`` items in flight per stage (see
+    :meth:`MultiThread.imap`), so memory doesn't depend on the input size.
+
+    A stage returning None for an item drops it.
+
+    >>> def parse(line, thread_id):
+    ...    return int(line)
+    >>> def square(n, thread_id):
+    ...    return n * n
+    >>> def even(n, thread_id):
+    ...    return n if n % 2 == 0 else None
+    >>> pipeline = Pipeline().stage(parse, n_workers=4).stage(square, backend='process', n_workers=2).stage(even)
+    >>> with pipeline:
+    ...    pipeline.run(str(n) for n in range(10))
+    [0, 4, 16, 36, 64]
+
+    :param bool ordered: keep the order of the input, instead of yielding results when available
+    """
+
+    def __init__(self, ordered=True):
+        self.ordered = ordered
+        self.stages = []
+
+    def stage(self, processor, n_workers=5, backend=None, buffer_size=None, **kwargs):
+        """
+        Add a stage, see :class:`MultiThread` and :class:`MultiProcess` for the arguments.
+
+        :param callable processor: called for each item, with ``thread_id`` by default
+        :param str backend: ``'thread'`` (default) or ``'process'``
+        :param int buffer_size: maximum amount of items in flight in this stage
+        :return: the pipeline itself, to chain stages
+        :rtype: Pipeline
+        """
+        if backend == 'async':
+            raise ValueError("Pipeline stages can't use the async backend")
+        executor = _executor(backend, processor, n_workers, **kwargs)
+        self.stages.append((executor, buffer_size))
+        return self
+
+    def imap(self, iterable):
+        """Yield the results of the last stage, as soon as they are available"""
+        for executor, buffer_size in self.stages:
+            iterable = executor.imap(iterable, ordered=self.ordered, buffer_size=buffer_size)
+        return iter(iterable)
+
+    def run(self, iterable) -> list:
+        return list(self.imap(iterable))
+
+    def close(self):
+        """Stop the workers of all stages"""
+        for executor, _ in self.stages:
+            executor.close()
+        for executor, _ in self.stages:
+            executor.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+
+def multithreaded(*args, class_method_with_self=False, pre_start=False, backend=None, **kwargs):
     """
     Decorator version for multithreading
 
@@ -324,6 +1679,11 @@ def multithreaded(*args, class_method_with_self=False, pre_start=False, **kwargs
     >>> all(k['thread_id'] in [0, 1] for a, k in res)
     True
 
+    Use ``backend='process'`` (or :func:`multiprocessed`) to process in
+    worker processes using :class:`MultiProcess` instead, or
+    ``backend='async'`` for coroutine processors using :class:`MultiAsync`
+    (the decorated function is then awaitable when called from async code).
+
     .. seealso:: :func:`singlethreaded`
     """
 
@@ -332,7 +1692,7 @@ def multithreaded(*args, class_method_with_self=False, pre_start=False, **kwargs
     a.extend(args)
     args = a
 
-    mt = MultiThread(*args, **kwargs)
+    mt = _executor(backend, *args, **kwargs)
     del args, kwargs
 
     def _decorator(func):
@@ -342,9 +1702,7 @@ def multithreaded(*args, class_method_with_self=False, pre_start=False, **kwargs
             if class_method_with_self:
                 args = list(args)
                 args[0], alist = alist, args[0]
-            if not pre_start:
-                mt.extend(alist)
-                return mt.run(*args, **kwargs)
+            # items are fed lazily (see MultiThread.run_with_iter), pre_start is kept for compatibility
             return mt.run_with_iter(alist, *args, **kwargs)
 
         _._multithread = mt
@@ -354,3 +1712,21 @@ def multithreaded(*args, class_method_with_self=False, pre_start=False, **kwargs
 
 
 multithreadedmethod = partial(multithreaded, class_method_with_self=True)
+
+
+def multiprocessed(*args, **kwargs):
+    """
+    Decorator version for multiprocessing, same as ``multithreaded(backend='process')``
+
+    >>> @multiprocessed(2, chunksize=10)
+    ... def square(n, thread_id):
+    ...    return n * n
+    >>> sorted(square(range(0, 5)))
+    [0, 1, 4, 9, 16]
+
+    .. seealso:: :func:`multithreaded`, :class:`MultiProcess`
+    """
+    return multithreaded(*args, backend='process', **kwargs)
+
+
+multiprocessedmethod = partial(multiprocessed, class_method_with_self=True)
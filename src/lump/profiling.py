@@ -1,5 +1,17 @@
+from collections import deque, Counter
+from functools import wraps
+import contextvars
+import gc
+import json
 import logging
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 
 
 class timeit:
@@ -17,6 +29,19 @@ class timeit:
         >>> with timeit("Took a long time", 1000, logger=logger):
         ...    pass
 
+    When the :class:`Tracer` is enabled, nested ``timeit`` blocks (also across
+    threads started with a copy of the context, e.g. ``MultiThread`` workers)
+    are recorded as a tree of spans:
+
+        >>> tracer.enable()
+        >>> with timeit("outer"):
+        ...     with timeit("inner"):
+        ...         pass
+        >>> tracer.disable()
+        >>> [(span.name, [child.name for child in span.children]) for span in tracer.traces]
+        [('outer', ['inner'])]
+        >>> tracer.clear()
+
     Or alternatively you can:
 
         >>> timer = timeit()
@@ -45,6 +70,7 @@ class timeit:
         if postfix is not None:
             self.postfix = postfix
         self.callback = self._default_callback if callback is None else callback
+        self._span = None
 
     def restart(self):
         self.start = time.monotonic()
@@ -53,10 +79,15 @@ class timeit:
         return (time.monotonic() - self.start)*1000
 
     def __enter__(self):
+        self._span = tracer.start_span(self.text) if tracer.enabled else None
         self.restart()
+        return self
 
     def __exit__(self, kind, value, traceback):
         ms = self.elapsed()
+        if self._span is not None:
+            tracer.end_span(self._span)
+            self._span = None
         is_slow = self.min_time is not None and ms > self.min_time
         self.callback(ms, is_slow, self.text, kind, value, traceback)
 
@@ -69,3 +100,779 @@ class timeit:
             self.logger.info(text + postfix, ms)
         elif is_slow:
             self.logger.warning(text + postfix, ms)
+
+
+class Span:
+    """A timed, named block in a trace, see :class:`Tracer`"""
+
+    __slots__ = ('name', 'parent', 'children', 'thread_id', 'thread_name', 'start', 'end', '_token')
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = []
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.start = time.perf_counter()
+        self.end = None
+        self._token = None
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+    def walk(self):
+        """Iterate over this span and all its descendants"""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.name)
+
+
+# marks a trace that was not sampled, so nested blocks skip it as well
+_not_sampled = object()
+_current_span = contextvars.ContextVar('lump_profiling_span', default=None)
+
+
+class Tracer:
+    """
+    Collects trees of nested :class:`timeit` spans, keeping the last
+    ``max_traces`` finished root spans. With a ``sample_rate`` below 1, only
+    that fraction of traces (decided at the root span) is recorded.
+
+    Spans follow the :mod:`contextvars` context, so threads need to run in a
+    copy of the context of their parent (``contextvars.copy_context().run``),
+    which ``MultiThread`` does for its workers.
+
+    >>> tracer = Tracer()
+    >>> tracer.enable()
+    >>> root = tracer.start_span('root')
+    >>> tracer.end_span(tracer.start_span('child'))
+    >>> tracer.end_span(root)
+    >>> [event['name'] for event in tracer.to_chrome_trace()['traceEvents']]
+    ['root', 'child']
+    >>> [event['type'] for event in tracer.to_speedscope()['profiles'][0]['events']]
+    ['O', 'O', 'C', 'C']
+    """
+
+    def __init__(self, sample_rate=None, max_traces=None):
+        self.enabled = False
+        self.sample_rate = 1. if sample_rate is None else sample_rate
+        self.traces = deque(maxlen=1000 if max_traces is None else max_traces)
+        self._epoch = time.perf_counter()
+
+    def enable(self, sample_rate=None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.traces.clear()
+
+    def start_span(self, name):
+        """
+        Start a span as child of the current one
+
+        :return: the span, or None if the trace isn't sampled
+        """
+        parent = _current_span.get()
+        if parent is _not_sampled:
+            return None
+        if parent is None and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            _current_span.set(_not_sampled)
+            return _not_sampled
+
+        span = Span(name, parent)
+        if parent is not None:
+            parent.children.append(span)
+        span._token = _current_span.set(span)
+        return span
+
+    def end_span(self, span):
+        if span is None:
+            return
+        if span is _not_sampled:
+            _current_span.set(None)
+            return
+
+        span.end = time.perf_counter()
+        try:
+            _current_span.reset(span._token)
+        except ValueError:
+            # ended in another context than it was started in
+            _current_span.set(span.parent)
+        span._token = None
+        if span.parent is None:
+            self.traces.append(span)
+
+    def _spans(self):
+        for trace in list(self.traces):
+            yield from trace.walk()
+
+    def to_chrome_trace(self):
+        """
+        :return: Chrome Trace Event format (``chrome://tracing``, Perfetto), as dict
+        """
+        pid = os.getpid()
+        events = []
+        for span in self._spans():
+            if span.end is None:
+                continue
+            events.append(dict(name=str(span.name), ph='X', pid=pid, tid=span.thread_id,
+                               ts=(span.start - self._epoch) * 1e6, dur=span.duration * 1e6))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def to_speedscope(self, name=None):
+        """
+        :return: speedscope evented profile format, one profile per thread, as dict
+        """
+        frames = {}
+        events_per_thread = {}
+        thread_names = {}
+
+        def add_events(span, events):
+            frame = frames.setdefault(str(span.name), len(frames))
+            events.append(dict(type='O', frame=frame, at=(span.start - self._epoch) * 1e6))
+            for child in span.children:
+                if child.thread_id == span.thread_id and child.end is not None:
+                    add_events(child, events)
+            events.append(dict(type='C', frame=frame, at=(span.end - self._epoch) * 1e6))
+
+        thread_roots = [span for span in self._spans() if span.end is not None and
+                        (span.parent is None or span.parent.thread_id != span.thread_id)]
+        for span in sorted(thread_roots, key=lambda span: span.start):
+            thread_names[span.thread_id] = span.thread_name
+            add_events(span, events_per_thread.setdefault(span.thread_id, []))
+
+        profiles = []
+        for thread_id, events in events_per_thread.items():
+            profiles.append(dict(type='evented', name=thread_names[thread_id], unit='microseconds',
+                                 startValue=events[0]['at'], endValue=max(event['at'] for event in events),
+                                 events=events))
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': 'lump trace' if name is None else name,
+            'shared': dict(frames=[dict(name=frame) for frame in frames]),
+            'profiles': profiles,
+        }
+
+    def export(self, path, format=None):
+        """
+        Write the traces to a file
+
+        :param str path: file to write to
+        :param str format: ``'chrome'`` (default) or ``'speedscope'``
+        """
+        if format is None or format == 'chrome':
+            data = self.to_chrome_trace()
+        elif format == 'speedscope':
+            data = self.to_speedscope()
+        else:
+            raise ValueError("Unknown format %r, expected 'chrome' or 'speedscope'" % (format,))
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+
+tracer = Tracer()
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of durations, with logarithmic buckets that are each
+    split in ``2 ** sub_bucket_bits`` linear sub buckets, so percentiles stay
+    within a few percent of the real value with constant memory.
+
+    >>> hist = LatencyHistogram()
+    >>> for ms in range(1, 101):
+    ...     hist.record(ms / 1000)
+    >>> hist.count
+    100
+    >>> round(hist.percentile(50) * 1000)
+    50
+    >>> 97 <= round(hist.percentile(99) * 1000) <= 101
+    True
+    """
+
+    def __init__(self, sub_bucket_bits=None, resolution=None):
+        """
+        :param int sub_bucket_bits: precision of the buckets
+        :param float resolution: smallest duration to distinguish in seconds, default 1µs
+        """
+        self.sub_bucket_bits = 5 if sub_bucket_bits is None else sub_bucket_bits
+        self.resolution = 1e-6 if resolution is None else resolution
+        self.count = 0
+        self._buckets = {}
+
+    def _index(self, value):
+        sub_bits = self.sub_bucket_bits
+        if value < (2 << sub_bits):
+            return value
+        shift = value.bit_length() - sub_bits - 1
+        return (shift << sub_bits) + (value >> shift)
+
+    def _value(self, index):
+        """Middle of the range of values in the bucket with the given index"""
+        sub_bits = self.sub_bucket_bits
+        if index < (2 << sub_bits):
+            return index
+        shift = (index >> sub_bits) - 1
+        return ((index - (shift << sub_bits)) << shift) + (1 << shift) / 2
+
+    def record(self, seconds):
+        index = self._index(int(seconds / self.resolution))
+        buckets = self._buckets
+        buckets[index] = buckets.get(index, 0) + 1
+        self.count += 1
+
+    def percentile(self, percentile):
+        """
+        :param float percentile: 0-100
+        :return: duration in seconds, or None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        threshold = self.count * percentile / 100
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= threshold:
+                return self._value(index) * self.resolution
+        return self._value(max(self._buckets)) * self.resolution
+
+
+class ProfileStats:
+    """Aggregated statistics of a profiled function or block"""
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.errors = 0
+            self.total = 0.
+            self.min = None
+            self.max = None
+            self.histogram = LatencyHistogram()
+
+    def record(self, seconds, error=False):
+        with self._lock:
+            self.count += 1
+            if error:
+                self.errors += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+            self.histogram.record(seconds)
+
+    def snapshot(self):
+        """
+        :return: dict with count, errors, total, mean, min, max and percentiles (in seconds)
+        """
+        with self._lock:
+            result = dict(count=self.count, errors=self.errors, total=self.total,
+                          mean=self.total / self.count if self.count else None, min=self.min, max=self.max)
+            for percentile in self.percentiles:
+                result['p%d' % (percentile,)] = self.histogram.percentile(percentile)
+        return result
+
+
+class ProfileRegistry:
+    """
+    Process-wide registry of :class:`ProfileStats`, filled by :func:`profiled`.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._dump_thread = None
+        self._dump_stop = None
+
+    def get(self, name):
+        try:
+            return self._stats[name]
+        except KeyError:
+            with self._lock:
+                return self._stats.setdefault(name, ProfileStats(name))
+
+    def snapshot(self):
+        """
+        :return: dict of name to :meth:`ProfileStats.snapshot`
+        """
+        return {name: stats.snapshot() for name, stats in list(self._stats.items())}
+
+    def reset(self):
+        for stats in list(self._stats.values()):
+            stats.reset()
+
+    def format(self, snapshot=None):
+        """Format the snapshot as a table, sorted by total time spent"""
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        def ms(value):
+            return '-' if value is None else '%.2f' % (value * 1000,)
+
+        row = '%-40s %8s %6s %10s %8s %8s %8s %8s'
+        lines = [row % ('name', 'count', 'errors', 'total(ms)', 'mean', 'p50', 'p95', 'p99')]
+        for name, stats in sorted(snapshot.items(), key=lambda item: -item[1]['total']):
+            lines.append(row % (
+                name, stats['count'], stats['errors'], ms(stats['total']), ms(stats['mean']),
+                ms(stats['p50']), ms(stats['p95']), ms(stats['p99'])))
+        return '\n'.join(lines)
+
+    def dump(self, logger=None, level=None, reset=False):
+        snapshot = self.snapshot()
+        if reset:
+            self.reset()
+        logger = self.logger if logger is None else logger
+        logger.log(logging.INFO if level is None else level, 'Profile:\n%s', self.format(snapshot))
+
+    def start_periodic_dump(self, interval, logger=None, level=None, reset=False):
+        """
+        Dump the statistics every ``interval`` seconds from a background thread
+
+        :param float interval: seconds between dumps
+        :param bool reset: reset the statistics after each dump
+        """
+        self.stop_periodic_dump()
+        stop = threading.Event()
+
+        def _dump():
+            while not stop.wait(interval):
+                self.dump(logger, level, reset)
+
+        self._dump_stop = stop
+        self._dump_thread = threading.Thread(target=_dump, daemon=True)
+        self._dump_thread.start()
+
+    def stop_periodic_dump(self):
+        if self._dump_stop is None:
+            return
+        self._dump_stop.set()
+        self._dump_thread.join()
+        self._dump_stop = None
+        self._dump_thread = None
+
+
+registry = ProfileRegistry()
+
+
+class _Profiled:
+    def __init__(self, name=None, registry_=None):
+        self.name = name
+        self.registry = registry if registry_ is None else registry_
+        self._start = threading.local()
+
+    def __enter__(self):
+        self._stats = self.registry.get(self.name)
+        starts = getattr(self._start, 'stack', None)
+        if starts is None:
+            starts = self._start.stack = []
+        starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self._stats.record(time.perf_counter() - self._start.stack.pop(), kind is not None)
+
+    def __call__(self, func):
+        stats = self.registry.get(self.name or '%s.%s' % (func.__module__, func.__qualname__))
+        record = stats.record
+        perf_counter = time.perf_counter
+
+        @wraps(func)
+        def _(*args, **kwargs):
+            start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                record(perf_counter() - start, True)
+                raise
+            record(perf_counter() - start)
+            return result
+        _.profile_stats = stats
+        return _
+
+
+def profiled(name=None, registry=None):
+    """
+    Record call counts, errors, total time and latency percentiles of a
+    function (as decorator) or block (as context manager) in a
+    :class:`ProfileRegistry`, by default the process-wide ``registry``.
+
+    >>> @profiled
+    ... def test():
+    ...     pass
+    >>> for _ in range(10):
+    ...     test()
+    >>> with profiled('block'):
+    ...     time.sleep(.01)
+    >>> stats = registry.snapshot()
+    >>> stats['lump.profiling.test']['count']
+    10
+    >>> stats['block']['p99'] > .009
+    True
+    >>> print(registry.format())  # doctest: +ELLIPSIS
+    name                                        count errors  total(ms)     mean      p50      p95      p99
+    block                                           1      0 ...
+    >>> registry.reset()
+    >>> registry.snapshot()['block']['count']
+    0
+
+    :param str name: name to register under, defaults to the qualified name of the function
+    :param ProfileRegistry registry: registry to record in
+    """
+    if callable(name):
+        return _Profiled(None, registry)(name)
+    return _Profiled(name, registry)
+
+
+class SamplingProfiler:
+    """
+    Low overhead sampling profiler: captures the stacks of all threads every
+    ``interval`` seconds, from a background thread or (``use_signal=True``,
+    only from the main thread) a ``SIGPROF`` interval timer, and aggregates
+    them in collapsed stack format, usable for flamegraphs (e.g. flamegraph.pl
+    or speedscope).
+
+    >>> profiler = SamplingProfiler(interval=.001)
+    >>> profiler.start()
+    >>> def busy():
+    ...     end = time.monotonic() + .05
+    ...     while time.monotonic() < end:
+    ...         pass
+    >>> busy()
+    >>> profiler.stop()
+    >>> 'busy' in profiler.collapsed()
+    True
+
+    :param float interval: seconds between samples
+    :param bool use_signal: sample from a timer signal instead of a thread
+    :param bool include_thread_names: start each stack with the name of the thread
+    """
+
+    def __init__(self, interval=None, use_signal=False, include_thread_names=True):
+        self.interval = .005 if interval is None else interval
+        self.use_signal = use_signal
+        self.include_thread_names = include_thread_names
+        self.stacks = Counter()
+        self.samples = 0
+        self._thread = None
+        self._stop = None
+        self._previous_handler = None
+
+    @property
+    def running(self):
+        return self._thread is not None or self._previous_handler is not None
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+    def sample(self, exclude_thread_id=None, in_signal_handler=False):
+        """
+        Record the current stack of all threads
+
+        :param bool in_signal_handler: called from a signal handler, so locks held by the interrupted code
+            (like the one of :func:`threading.enumerate`) must not be taken
+        """
+        if in_signal_handler:
+            # copying the dict is atomic, unlike iterating it
+            names = {ident: thread.name for ident, thread in dict(getattr(threading, '_active', {})).items()}
+        else:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == exclude_thread_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            if self.include_thread_names:
+                stack.append(names.get(thread_id, str(thread_id)))
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+        self.samples += 1
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(own_id)
+
+    def _signal_handler(self, signum, frame):
+        self.sample(in_signal_handler=True)
+
+    def start(self):
+        if self.running:
+            return
+        if self.use_signal:
+            self._previous_handler = signal.signal(signal.SIGPROF, self._signal_handler)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lump-sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._previous_handler is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+            self._previous_handler = None
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def clear(self):
+        self.stacks.clear()
+        self.samples = 0
+
+    def collapsed(self):
+        """
+        :return: one ``frame;frame;frame count`` line per unique stack, root first
+        :rtype: str
+        """
+        return '\n'.join('%s %d' % item for item in sorted(self.stacks.items()))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+            f.write('\n')
+
+
+def default_profile_signal():
+    """
+    ``SIGRTMIN + 1`` where available, which isn't used by e.g. gunicorn (its
+    master re-executes itself on ``SIGUSR2``, so that's no safe fallback)
+    """
+    if not hasattr(signal, 'SIGRTMIN'):
+        raise ValueError("No realtime signals available, expected an explicit signal number")
+    return signal.SIGRTMIN + 1
+
+
+def install_profiler_toggle(signum=None, path=None, **kwargs):
+    """
+    Install a handler for ``signum`` that starts a :class:`SamplingProfiler`,
+    and on the next signal stops it and writes the collapsed stacks to
+    ``path`` (formatted with the pid). Forked processes (e.g. gunicorn
+    workers) inherit the handler, each profiling itself.
+
+    :param int signum: signal to toggle on, see :func:`default_profile_signal`
+    :param str path: file to write to, by default ``<tempdir>/lump-profile-%d.collapsed``
+    :param kwargs: arguments for :class:`SamplingProfiler`
+    :return: the signal number
+    """
+    if signum is None:
+        signum = default_profile_signal()
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), 'lump-profile-%d.collapsed')
+
+    profilers = {}
+
+    def _toggle(signum_, frame):
+        pid = os.getpid()
+        profiler = profilers.get(pid)
+        if profiler is None:
+            # forked processes don't have the profiler thread of their parent
+            profilers.clear()
+            profiler = profilers[pid] = SamplingProfiler(**kwargs)
+        if profiler.running:
+            profiler.stop()
+            profiler.write(path % (pid,))
+            profiler.clear()
+            timeit.logger.warning('Wrote profile to %s', path % (pid,))
+        else:
+            profiler.start()
+            timeit.logger.warning('Started sampling profiler in process %d', pid)
+
+    signal.signal(signum, _toggle)
+    return signum
+
+
+def register_profiler_command(handler, pids, signum=None, command=None):
+    """
+    Register a command on an :class:`lump.keypress.InteractiveTerminalHandler`
+    that toggles the profilers installed using :func:`install_profiler_toggle`.
+
+    :param handler: the interactive terminal handler
+    :param callable pids: returns the pids of the processes to toggle, only ones that installed the toggle
+        (or inherited it): other processes are terminated by the default action of realtime signals
+    :param int signum: the signal the toggle was installed for
+    :param str command: name of the command, ``profile`` by default
+    """
+    if signum is None:
+        signum = default_profile_signal()
+
+    def _toggle_profilers():
+        for pid in pids():
+            if pid != os.getpid():
+                os.kill(pid, signum)
+
+    handler.register('profile' if command is None else command, _toggle_profilers,
+                     'Start or stop the sampling profiler, and write the collapsed stacks')
+
+
+class MemoryTracker:
+    """
+    Snapshot and diff tooling based on :mod:`tracemalloc` and object counts,
+    to find the allocation sites and types that keep growing.
+
+    >>> tracker = MemoryTracker()
+    >>> class Leak:
+    ...     def __init__(self):
+    ...         self.data = [0] * 100
+    >>> tracker.snapshot()
+    >>> leak = [Leak() for _ in range(1000)]
+    >>> diff = tracker.diff()
+    >>> diff[0].size_diff > 800000
+    True
+    >>> tracker.type_count_diff()['Leak']
+    1000
+    >>> 'Leak' in tracker.report()
+    True
+    >>> tracker.stop()
+
+    :param int frames: amount of frames to keep per allocation
+    :param int limit: amount of allocation sites and types to report
+    """
+
+    def __init__(self, frames=None, limit=None):
+        self.frames = 1 if frames is None else frames
+        self.limit = 10 if limit is None else limit
+        self.baseline = None
+        self.baseline_types = None
+        self._started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self.baseline = None
+        self.baseline_types = None
+
+    @staticmethod
+    def _take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    @staticmethod
+    def type_counts():
+        """
+        :return: amount of objects tracked by the garbage collector per type
+        :rtype: collections.Counter
+        """
+        return Counter(type(obj).__qualname__ for obj in gc.get_objects())
+
+    def snapshot(self):
+        """Start tracing (if needed) and take the baseline to compare with"""
+        self.start()
+        self.baseline = self._take_snapshot()
+        self.baseline_types = self.type_counts()
+
+    def diff(self, key_type='lineno'):
+        """
+        :return: allocation sites sorted by growth since the baseline
+        :rtype: list of tracemalloc.StatisticDiff
+        """
+        if self.baseline is None:
+            raise ValueError("No baseline snapshot taken")
+        return self._take_snapshot().compare_to(self.baseline, key_type)
+
+    def type_count_diff(self):
+        """
+        :return: growth of the amount of objects per type since the baseline
+        :rtype: collections.Counter
+        """
+        counts = self.type_counts()
+        counts.subtract(self.baseline_types or Counter())
+        return counts
+
+    def report(self, limit=None):
+        """
+        :return: top allocation sites by growth and top types by growth (or by count without baseline)
+        :rtype: str
+        """
+        limit = self.limit if limit is None else limit
+        lines = []
+        if self.baseline is not None:
+            lines.append('Top %d allocation sites by growth:' % (limit,))
+            lines.extend('  %s' % (stat,) for stat in self.diff()[:limit])
+            lines.append('Top %d types by growth:' % (limit,))
+            counts = self.type_count_diff()
+        else:
+            lines.append('Top %d types by count:' % (limit,))
+            counts = self.type_counts()
+        lines.extend('  %-40s %+d' % item for item in counts.most_common(limit))
+        return '\n'.join(lines)
+
+
+def default_memory_signals():
+    """``SIGRTMIN + 2`` and ``SIGRTMIN + 3`` (snapshot and diff), where available"""
+    if not hasattr(signal, 'SIGRTMIN'):
+        raise ValueError("No realtime signals available, expected explicit signal numbers")
+    return signal.SIGRTMIN + 2, signal.SIGRTMIN + 3
+
+
+def install_memory_signals(snapshot_signum=None, diff_signum=None, path=None, **kwargs):
+    """
+    Install handlers that take a :class:`MemoryTracker` snapshot on
+    ``snapshot_signum`` and log and write a report on ``diff_signum`` to
+    ``path`` (formatted with the pid). Forked processes inherit the handlers.
+
+    :param int snapshot_signum: signal to take a snapshot on
+    :param int diff_signum: signal to report on
+    :param str path: file to write to, by default ``<tempdir>/lump-mem-%d.txt``
+    :param kwargs: arguments for :class:`MemoryTracker`
+    :return: the signal numbers
+    """
+    if snapshot_signum is None or diff_signum is None:
+        snapshot_signum, diff_signum = default_memory_signals()
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), 'lump-mem-%d.txt')
+
+    trackers = {}
+
+    def _tracker():
+        pid = os.getpid()
+        if pid not in trackers:
+            trackers.clear()
+            trackers[pid] = MemoryTracker(**kwargs)
+        return trackers[pid]
+
+    def _snapshot(signum, frame):
+        _tracker().snapshot()
+        timeit.logger.warning('Took memory snapshot in process %d', os.getpid())
+
+    def _diff(signum, frame):
+        report = _tracker().report()
+        with open(path % (os.getpid(),), 'w') as f:
+            f.write(report)
+            f.write('\n')
+        timeit.logger.warning('Memory report of process %d:\n%s', os.getpid(), report)
+
+    signal.signal(snapshot_signum, _snapshot)
+    signal.signal(diff_signum, _diff)
+    return snapshot_signum, diff_signum
@@ -0,0 +1,76 @@
+from lump.cache import CacheKey, FileCacher
+import pickle
+import zlib
+
+
+def test_filecacher_zdict(tmp_path):
+    cache = FileCacher(str(tmp_path))
+    for i in range(50):
+        cache['key%d' % i] = {'id': i, 'title': 'Some title %d' % i, 'type': 'video', 'tags': ['a', 'b']}
+
+    assert cache.train_zdict()
+    assert (tmp_path / 'zdict').exists()
+
+    # entries written before training are still readable
+    assert cache['key1']['id'] == 1
+
+    cache['new'] = {'id': 50, 'title': 'Some title 50', 'type': 'video', 'tags': ['a', 'b']}
+    with open(cache._filename('new'), 'rb') as f:
+        data = f.read()
+    plain = zlib.compress(pickle.dumps(cache['new'], pickle.HIGHEST_PROTOCOL))
+    assert len(data) < len(plain)
+
+    assert FileCacher(str(tmp_path), zdict=True)['new']['id'] == 50
+    # the stored dictionary is loaded by default
+    assert FileCacher(str(tmp_path))['new']['id'] == 50
+
+    # without it, entries written with it are missing, but kept
+    assert 'new' not in FileCacher(str(tmp_path), zdict=False)
+    assert cache['new']['id'] == 50
+
+
+def test_filecacher_zdict_other_dictionary(tmp_path):
+    cache = FileCacher(str(tmp_path), zdict=b'some dictionary')
+    cache['key'] = 'value'
+    assert cache['key'] == 'value'
+    assert 'key' not in FileCacher(str(tmp_path), zdict=b'another dictionary')
+
+
+def test_filecacher_zdict_versioned(tmp_path):
+    cache = FileCacher(str(tmp_path), version=2)
+    assert not cache.train_zdict()
+    for i in range(10):
+        cache['key%d' % i] = {'id': i, 'value': 'value %d' % i}
+    assert cache.train_zdict()
+    assert (tmp_path / 'v2_zdict').exists()
+    assert FileCacher(str(tmp_path), zdict=True)._zdict is None
+
+
+def test_filecacher_unversioned_ignores_versioned_entries(tmp_path):
+    versioned = FileCacher(str(tmp_path), version=2)
+    versioned['key'] = 'versioned'
+    unversioned = FileCacher(str(tmp_path))
+    unversioned['key'] = 'unversioned'
+    assert len(unversioned) == len(versioned) == 1
+    unversioned.clear()
+    assert len(unversioned) == 0
+    assert versioned['key'] == 'versioned'
+
+
+def test_cachekey_unhashable_transformed_args():
+    def func(a, session, b):
+        pass
+
+    key = CacheKey(func, ignore=['session'])
+    assert key([1], 's', 2) != key([1], 's', 3)
+    assert key([1], 's', 2) == key([1], 'other', 2)
+
+    calls = []
+
+    def lower(value):
+        calls.append(value)
+        return value.lower()
+
+    key = CacheKey(func, key_funcs={'b': lower})
+    assert key([1], 's', 'B') == key([1], 's', 'b')
+    assert calls == ['B', 'b']
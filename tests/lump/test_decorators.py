@@ -1,5 +1,8 @@
 import logging
-from lump.decorators import log_call
+import pytest
+from lump.decorators import log_call, cache, classcache, retry, RetryBudget, \
+    circuit_breaker, CircuitBreaker, CircuitOpenError, batched, rate_limited, TokenBucket
+from lump.cache import FileCacher, LocalCacher
 
 
 def test_log_call(caplog):
@@ -42,3 +45,321 @@ def test_log_call3(caplog):
     assert caplog.record_tuples == [
         ('testname', logging.DEBUG, "funcname()"),
     ]
+
+
+def test_memoize_kwargs():
+    calls = []
+
+    @cache()
+    def test(*args, **kwargs):
+        calls.append((args, kwargs))
+        return len(calls)
+
+    assert test('a|b') == 1
+    assert test('a', 'b') == 2
+    assert test('a', b='c') == 3
+    assert test('a', b='c') == 3
+    assert test(['unhashable']) == 4
+    assert test(['unhashable']) == 4
+
+
+def test_memoize_digest_keys(tmp_path):
+    @cache(FileCacher(str(tmp_path)))
+    def test(*args, **kwargs):
+        return args, kwargs
+
+    assert test(1, x=[2]) == ((1,), {'x': [2]})
+    assert test('1', x=[2]) == (('1',), {'x': [2]})
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_memoize_ttl(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr('lump.decorators.time.time', lambda: now[0])
+    calls = []
+
+    @cache(ttl=10)
+    def test(a):
+        """docstring"""
+        calls.append(a)
+        return a
+
+    assert test.__name__ == 'test'
+    assert test.__doc__ == 'docstring'
+    assert test(None) is None
+    assert test(None) is None
+    assert calls == [None]
+    now[0] += 11
+    assert test(None) is None
+    assert calls == [None, None]
+    assert test.cache_info().hits == 1
+    assert test.cache_info().misses == 2
+
+
+def test_memoize_ttl_change(tmp_path, monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr('lump.decorators.time.time', lambda: now[0])
+    cacher = FileCacher(str(tmp_path))
+    calls = []
+
+    def test(a):
+        calls.append(a)
+        return a
+
+    assert cache(cacher)(test)((1, 'x')) == (1, 'x')
+    # cached without ttl, not an expired (expires, value) entry
+    assert cache(cacher, ttl=10)(test)((1, 'x')) == (1, 'x')
+    assert len(calls) == 2
+    assert cache(cacher, ttl=10)(test)((1, 'x')) == (1, 'x')
+    assert len(calls) == 2
+    # cached with ttl, the value is returned until it expires
+    assert cache(cacher)(test)((1, 'x')) == (1, 'x')
+    assert len(calls) == 2
+    now[0] += 11
+    assert cache(cacher)(test)((1, 'x')) == (1, 'x')
+    assert len(calls) == 3
+
+
+def test_memoize_file_cacher(tmp_path):
+    cacher = FileCacher(str(tmp_path))
+
+    @cache(cacher)
+    def test(a):
+        return a * 2
+
+    @cache(cacher)
+    def other(a):
+        return a * 3
+
+    assert test(2) == 4
+    assert test(2) == 4
+    assert test(3) == 6
+    # keys are namespaced per function
+    assert other(2) == 6
+    info = test.cache_info()
+    # the size of a shared cacher isn't that of this function
+    assert (info.hits, info.misses, info.maxsize, info.currsize) == (1, 2, None, None)
+    assert test.cache_delete(2)
+    assert not test.cache_delete(2)
+    assert len(cacher) == 2
+    with pytest.raises(ValueError):
+        test.cache_clear()
+    assert len(cacher) == 2
+
+
+def test_classcache_version_and_get_cacher_once():
+    cacher = LocalCacher()
+    resolved = []
+
+    class A:
+        classcacheVersionNumber = 3
+
+        def get_cacher(self):
+            resolved.append(self)
+            return cacher
+
+        @classcache
+        def test(self, a, b=None):
+            return a, b
+
+    a = A()
+    assert a.test(1, b=2) == (1, 2)
+    assert a.test(1, b=2) == (1, 2)
+    assert a.test(1) == (1, None)
+    assert len(resolved) == 1
+    assert len(cacher) == 2
+    assert all(key[:2] == ['test', 'v:3'] for key in cacher.dict)
+
+
+def test_classcache_slots():
+    class A:
+        __slots__ = ('calls',)
+
+        def __init__(self):
+            self.calls = 0
+
+        def get_cacher(self):
+            return LocalCacher()
+
+        @classcache
+        def test(self):
+            self.calls += 1
+            return self.calls
+
+    a = A()
+    assert a.test() == 1
+    assert a.test() == 2
+    assert A.test.cache_size() == 0
+
+
+def test_retry_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('lump.decorators.time.sleep', sleeps.append)
+
+    @retry(5, sleep=1, backoff=2, max_sleep=5)
+    def test():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        test()
+    assert sleeps == [1, 2, 4, 5]
+    assert test.retry_info().sleep_time == 12
+
+
+def test_retry_backoff_without_sleep():
+    with pytest.raises(ValueError):
+        retry(5, backoff=2)
+    with pytest.raises(ValueError):
+        retry(5, max_sleep=5)
+    with pytest.raises(ValueError):
+        retry(5, jitter=True)
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=.5, max_tokens=10, min_retries_per_second=0)
+    attempts = []
+
+    @retry(3, budget=budget, callback=lambda attempt, error, delay: attempts.append(attempt))
+    def test():
+        raise ValueError()
+
+    for _ in range(4):
+        with pytest.raises(ValueError):
+            test()
+
+    # 4 calls deposit 2 tokens in total, so only 2 retries could be done
+    assert len(attempts) == 4 + 2
+    assert test.retry_info().budget_exhausted == 4
+
+
+def test_circuit_breaker_slow_calls(monkeypatch):
+    now = [0.]
+    monkeypatch.setattr('lump.decorators.time.monotonic', lambda: now[0])
+    breaker = CircuitBreaker(slow_call_duration=1, slow_call_rate=.5, window_size=4, minimum_calls=4,
+                             reset_timeout=10, half_open_calls=2)
+
+    @circuit_breaker(breaker)
+    def test(duration):
+        now[0] += duration
+        return duration
+
+    for duration in (0, 2, 0, 2):
+        test(duration)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        test(0)
+
+    now[0] += 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_circuit_breaker_interrupted_trial(monkeypatch):
+    now = [0.]
+    monkeypatch.setattr('lump.decorators.time.monotonic', lambda: now[0])
+    breaker = CircuitBreaker(minimum_calls=1, reset_timeout=10, exceptions=IOError)
+
+    @circuit_breaker(breaker)
+    def test(exception=None):
+        if exception is not None:
+            raise exception
+        return True
+
+    with pytest.raises(IOError):
+        test(IOError())
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now[0] += 10
+    with pytest.raises(KeyboardInterrupt):
+        test(KeyboardInterrupt())
+    # the interrupted trial neither closes the circuit nor uses up the trial call
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(IOError):
+        test(IOError())
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_batched_unhashable_and_errors():
+    @batched(max_size=2, max_wait=0)
+    def test(items):
+        if ['error'] in items:
+            raise ValueError()
+        return [item * 2 for item in items]
+
+    assert test([1]) == [1, 1]
+    with pytest.raises(ValueError):
+        test(['error'])
+
+    @batched(max_wait=0)
+    def missing(items):
+        return {}
+
+    with pytest.raises(KeyError):
+        missing(1)
+
+
+def test_log_call_disabled(caplog):
+    logger = logging.getLogger('testname')
+    caplog.set_level(logging.INFO)
+
+    class Arg:
+        def __repr__(self):
+            raise AssertionError('should not be formatted')
+
+    @log_call(logger, timing=True)
+    def test(*args, **kwargs):
+        return 'result'
+
+    assert test(Arg(), kw=Arg()) == 'result'
+    assert caplog.record_tuples == []
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.]
+
+    def sleep(seconds):
+        now[0] += seconds
+    monkeypatch.setattr('lump.decorators.time.monotonic', lambda: now[0])
+    monkeypatch.setattr('lump.decorators.time.sleep', sleep)
+    return now
+
+
+def test_token_bucket_waits(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    start = clock[0]
+    assert bucket.acquire() and bucket.acquire()
+    assert clock[0] == start
+    assert not bucket.acquire(blocking=False)
+    assert not bucket.acquire(timeout=.05)
+    assert bucket.acquire()
+    assert clock[0] == pytest.approx(start + .1)
+    # refilled at rate, up to burst
+    clock[0] += 10
+    assert bucket.acquire(2)
+    assert clock[0] == pytest.approx(start + 10.1)
+
+
+def test_rate_limited_per_key(clock):
+    calls = []
+
+    @rate_limited(10, burst=1, key=lambda host: host)
+    def get(host):
+        calls.append((host, clock[0]))
+
+    start = clock[0]
+    get('a'), get('b'), get('a')
+    assert calls == [('a', start), ('b', start), ('a', pytest.approx(start + .1))]
+    assert sorted(get.buckets) == ['a', 'b']
+
+
+def test_rate_limited_arguments():
+    with pytest.raises(ValueError):
+        rate_limited()
+    with pytest.raises(ValueError):
+        rate_limited(bucket=TokenBucket(10), key=lambda host: host)
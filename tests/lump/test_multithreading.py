@@ -1,4 +1,13 @@
-from lump.multithreading import MultiThread, multithreadedmethod
+from lump.multithreading import MultiThread, Pipeline, multithreaded, multithreadedmethod, multiprocessed
+from lump.multithreading import CancellationToken, Failure, RunCancelledError, UnsupportedOperationError
+from lump.multithreading import MultiProcess, WorkerDiedError
+from lump.decorators import TokenBucket
+import pytest
+import asyncio
+import gc
+import os
+import threading
+import time
 
 
 def test_multithreadedmethod():
@@ -13,3 +22,435 @@ def test_multithreadedmethod():
     b = A()
     assert type(b.test._multithread) is MultiThread
     assert type(b.get_multithread()) is MultiThread
+
+
+_initialized = []
+
+
+def _initializer(value):
+    _initialized.append(value)
+
+
+def _process(n, thread_id):
+    return n, thread_id, list(_initialized), os.getpid()
+
+
+def test_multiprocessed():
+    @multiprocessed(3, chunksize=7, initializer=_initializer, initargs=('init',))
+    def process(n, thread_id):
+        return _process(n, thread_id)
+
+    res = process(range(100))
+    assert sorted(n for n, _, _, _ in res) == list(range(100))
+    assert all(initialized == ['init'] for _, _, initialized, _ in res)
+    assert {thread_id for _, thread_id, _, _ in res} <= {0, 1, 2}
+    assert os.getpid() not in {pid for _, _, _, pid in res}
+    assert _initialized == []
+    assert not process._multithread._processes
+
+
+def test_multithreaded_async_backend():
+    @multithreaded(10, backend='async')
+    async def fetch(n, thread_id):
+        await asyncio.sleep(.01)
+        return n
+
+    assert sorted(fetch(range(50))) == list(range(50))
+
+    async def main():
+        return await fetch(range(5))
+
+    assert sorted(asyncio.run(main())) == list(range(5))
+
+
+def test_imap_backpressure():
+    fed = []
+
+    def source():
+        for n in range(1000):
+            fed.append(n)
+            yield n
+
+    t = MultiThread(lambda n, thread_id: n, n_workers=2)
+    for i, n in enumerate(t.imap(source(), ordered=True, buffer_size=4)):
+        assert n == i
+        # at most buffer_size items (plus the one the feeder is waiting with) ahead of the consumer
+        assert len(fed) <= i + 1 + 4 + 1
+    assert len(fed) == 1000
+
+
+def test_multithreaded_batch_chunks():
+    batches = []
+
+    @multithreaded(2, chunksize=32, batch=True)
+    def square(ns, thread_id):
+        batches.append(len(ns))
+        return [n * n for n in ns]
+
+    assert sorted(square(range(100))) == [n * n for n in range(100)]
+    assert sorted(batches) == [4, 32, 32, 32]
+
+
+def test_multithreaded_reuses_workers():
+    @multithreaded(4)
+    def proc(n, thread_id):
+        return n
+
+    proc(range(10))
+    threads = threading.active_count()
+    for _ in range(50):
+        assert sorted(proc(range(10))) == list(range(10))
+    assert threading.active_count() == threads
+    proc._multithread.close()
+    proc._multithread.join()
+    assert proc._multithread.threads == []
+
+
+def test_extend_between_runs():
+    t = MultiThread(lambda prefix, n, thread_id: '%s%d' % (prefix, n), n_workers=2)
+    t.extend(range(10))
+    assert sorted(t.run('a')) == sorted('a%d' % n for n in range(10))
+    t.extend(range(10))
+    time.sleep(.1)
+    assert sorted(t.run('b')) == sorted('b%d' % n for n in range(10))
+
+    t.timeout = .01
+    t.processor = lambda prefix, n, thread_id: time.sleep(.05)
+    t.extend(range(10))
+    with pytest.raises(RunCancelledError):
+        t.run('c')
+    t.timeout = None
+    t.processor = lambda prefix, n, thread_id: '%s%d' % (prefix, n)
+    t.extend(range(10))
+    time.sleep(.1)
+    assert sorted(t.run('d')) == sorted('d%d' % n for n in range(10))
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_rate_limit(batch):
+    class Bucket(TokenBucket):
+        acquired = 0
+
+        def acquire(self, tokens=1, blocking=True, timeout=None):
+            Bucket.acquired += tokens
+            return super().acquire(tokens, blocking, timeout)
+
+    t = MultiThread(lambda n, thread_id: n, n_workers=4, rate_limit=Bucket(100, burst=1),
+                    chunksize=5 if batch else None, batch=batch)
+    start = time.monotonic()
+    assert sorted(t.run_with_iter(range(10))) == list(range(10))
+    assert Bucket.acquired == 10
+    # the first (chunk of) items are taken from the burst, the others wait for the rate
+    assert time.monotonic() - start >= (.04 if batch else .085)
+    t = MultiThread(lambda n, thread_id: n, n_workers=4, rate_limit=100, burst=1)
+    assert isinstance(t.rate_limiter, TokenBucket)
+
+
+def test_idle_workers_stop():
+    t = MultiThread(lambda n, thread_id: n, n_workers=3, idle_timeout=.05)
+    assert sorted(t.run_with_iter(range(10))) == list(range(10))
+    assert len(t.threads) == 3
+    time.sleep(.3)
+    assert t.threads == []
+    assert sorted(t.run_with_iter(range(10))) == list(range(10))
+
+
+def test_unused_pool_stops_workers():
+    t = MultiThread(lambda n, thread_id: n, n_workers=3)
+    t.run_with_iter(range(10))
+    threads = t.threads
+    del t
+    gc.collect()
+    for thread in threads:
+        thread.join(1)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_worker_initializer():
+    class Session:
+        opened = []
+
+        def __init__(self, name):
+            self.name = name
+            self.closed = False
+            self.thread = threading.current_thread()
+            self.opened.append(self)
+
+        def close(self):
+            self.closed = True
+
+    @multithreaded(3, initializer=Session, initargs=('db',), finalizer=Session.close, pass_worker=True)
+    def proc(n, thread_id, worker):
+        assert worker.thread is threading.current_thread()
+        return worker.name, id(worker)
+
+    for _ in range(5):
+        res = proc(range(20))
+        assert {name for name, _ in res} == {'db'}
+    assert len(Session.opened) == 3
+    proc._multithread.close()
+    proc._multithread.join()
+    assert all(session.closed for session in Session.opened)
+
+
+def test_autoscaling():
+    t = MultiThread(lambda n, thread_id: time.sleep(.002), n_workers=1, min_workers=1, max_workers=16)
+    t.autoscaler.interval = .02
+    peak = 1
+    for _ in range(10):
+        t.run_with_iter(range(200))
+        peak = max(peak, t.n_workers)
+        assert 1 <= t.n_workers <= 16
+        assert len(t.threads) <= 16
+    assert peak > 2
+    t.close()
+    t.join()
+
+
+def test_pipeline_streams():
+    fed = []
+
+    def source():
+        for n in range(10000):
+            fed.append(n)
+            yield n
+
+    def fetch(n, thread_id):
+        return n
+
+    def parse(n, thread_id):
+        return n * 2
+
+    with Pipeline().stage(fetch, n_workers=4).stage(parse, n_workers=2, buffer_size=4) as pipeline:
+        for i, n in enumerate(pipeline.imap(source())):
+            assert n == i * 2
+            # every stage only has a bounded amount of items in flight
+            assert len(fed) <= i + 50
+            if i == 100:
+                break
+    assert len(fed) < 200
+    assert all(executor.threads == [] for executor, _ in pipeline.stages)
+
+
+def test_interactive_items_skip_bulk_backlog():
+    done = []
+
+    def proc(n, thread_id):
+        time.sleep(.001)
+        done.append(n)
+        return n
+
+    t = MultiThread(proc, n_workers=2, scheduling='priority', weights={'interactive': 5})
+    t.extend(range(1000), tag='bulk')
+    results = []
+    bulk = threading.Thread(target=lambda: results.extend(t.run()))
+    bulk.start()
+    time.sleep(.01)
+    futures = [t.submit(-n, tag='interactive') for n in range(1, 6)]
+    assert [future.result(timeout=5) for future in futures] == [-1, -2, -3, -4, -5]
+    assert len(done) < 100
+    bulk.join()
+    assert sorted(results) == list(range(1000))
+
+
+def test_failures_are_returned():
+    t = MultiThread(lambda n, thread_id: 10 // n, n_workers=2, return_failures=True)
+    res = t.run_with_iter([1, 0, 2])
+    assert sorted(r for r in res if not isinstance(r, Failure)) == [5, 10]
+    failure, = t.failures
+    assert failure in res
+    assert failure.item == 0
+    assert isinstance(failure.exception, ZeroDivisionError)
+
+
+def test_error_threshold_stops_run():
+    processed = []
+
+    def proc(n, thread_id):
+        processed.append(n)
+        raise ValueError(n)
+
+    t = MultiThread(proc, n_workers=2, max_errors=5)
+    with pytest.raises(RunCancelledError) as e:
+        t.run_with_iter(range(100000))
+    assert len(processed) < 100
+    errors = [f for f in e.value.failures if isinstance(f.exception, ValueError)]
+    assert len(errors) >= 5
+    assert e.value.failures == t.failures
+    # the pool is usable again
+    t.max_errors = None
+    t.processor = lambda n, thread_id: n
+    assert sorted(t.run_with_iter(f.item for f in e.value.failures)) == sorted(f.item for f in e.value.failures)
+
+
+def test_deadline_and_token():
+    t = MultiThread(lambda n, thread_id: time.sleep(.01), n_workers=2, timeout=.1)
+    start = time.monotonic()
+    with pytest.raises(RunCancelledError, match='deadline exceeded'):
+        t.run_with_iter(range(1000))
+    assert time.monotonic() - start < .5
+
+    token = CancellationToken()
+
+    def proc(n, thread_id, token):
+        if n == 10:
+            token.parent.parent.cancel('stop')
+        token.raise_if_cancelled()
+        return n
+
+    t = MultiThread(proc, n_workers=2, token=token, pass_token=True, item_timeout=1)
+    with pytest.raises(RunCancelledError, match='stop') as e:
+        t.run_with_iter(range(1000))
+    assert len(e.value.results) < 100
+
+
+def test_deadline_while_feeding():
+    t = MultiThread(lambda n, thread_id: time.sleep(.5), n_workers=1, feed_buffer_size=1, timeout=.05)
+    start = time.monotonic()
+    with pytest.raises(RunCancelledError, match='deadline exceeded'):
+        t.run_with_iter(range(10))
+    assert time.monotonic() - start < .3
+
+
+def test_item_timeout():
+    t = MultiThread(lambda n, thread_id: time.sleep(n), n_workers=2, item_timeout=.05)
+    assert t.run_with_iter([0, .1]) == []
+    failure, = t.failures
+    assert failure.item == .1
+    assert isinstance(failure.exception, TimeoutError)
+
+
+def test_submit_failure():
+    t = MultiThread(lambda n, thread_id: 1 // n, n_workers=1)
+    with pytest.raises(ZeroDivisionError):
+        t.submit(0).result(timeout=5)
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_failing_iterable_doesnt_block_pool(backend):
+    @multithreaded(2, backend=backend)
+    def proc(n, thread_id):
+        return n
+
+    def items():
+        yield 1
+        raise ValueError('broken input')
+
+    with pytest.raises(ValueError, match='broken input'):
+        proc(items())
+    assert sorted(proc(range(5))) == list(range(5))
+
+
+def test_multiprocessed_feeds_lazily():
+    @multiprocessed(2, chunksize=5)
+    def proc(n, thread_id):
+        return n
+
+    mp = proc._multithread
+    in_flight = []
+
+    def items():
+        for n in range(200):
+            in_flight.append(mp._pending)
+            yield n
+
+    assert sorted(proc(items())) == list(range(200))
+    # never more than feed_buffer_size chunks queued or processing
+    assert max(in_flight) <= mp.feed_buffer_size * mp.chunksize
+
+
+def test_multiprocessed_worker_dies():
+    @multiprocessed(2)
+    def proc(n, thread_id):
+        if n == 3:
+            os._exit(1)
+        return n
+
+    with pytest.raises(WorkerDiedError):
+        proc(range(10))
+    with pytest.raises(WorkerDiedError):
+        proc._multithread.run_with_iter(range(10))
+    assert sorted(proc(range(3))) == [0, 1, 2]
+
+
+def test_multiprocessed_unpicklable_result():
+    @multiprocessed(2)
+    def proc(n, thread_id):
+        return (lambda: n) if n == 3 else n
+
+    assert sorted(proc(range(5))) == [0, 1, 2, 4]
+
+
+def _square(n, thread_id):
+    return n * n
+
+
+@pytest.mark.parametrize('start_method', ['spawn', 'forkserver'])
+def test_multiprocess_start_method(start_method):
+    t = MultiProcess(_square, n_workers=2, chunksize=3, start_method=start_method)
+    assert sorted(t.run_with_iter(range(10))) == [n * n for n in range(10)]
+
+
+def test_multiprocess_warns_when_forking_threads(caplog):
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait, name='busy')
+    thread.start()
+    try:
+        t = MultiProcess(_square, n_workers=1, start_method='fork')
+        assert t.run_with_iter(range(3)) == [0, 1, 4]
+    finally:
+        stop.set()
+        thread.join()
+    assert 'busy' in caplog.text
+
+
+def test_imap_reraises_iterable_errors():
+    def items():
+        yield 1
+        yield 2
+        raise ValueError('broken input')
+
+    t = MultiThread(lambda n, thread_id: n, n_workers=2)
+    results = []
+    with pytest.raises(ValueError, match='broken input'):
+        for n in t.imap(items(), ordered=True):
+            results.append(n)
+    assert results == [1, 2]
+    assert not t.running
+
+
+def test_unsupported_operations():
+    t = multithreaded(2, backend='async')(lambda n, thread_id: n)._multithread
+    for method in (t.start, t.wait, t.submit):
+        with pytest.raises(UnsupportedOperationError):
+            method()
+    with pytest.raises(UnsupportedOperationError):
+        t.imap([])
+    with pytest.raises(NotImplementedError):
+        multiprocessed(2)(lambda n, thread_id: n)._multithread.submit(1)
+
+
+def test_failing_worker_initializer():
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) <= 2:
+            raise ConnectionError('no database')
+        return 'connection'
+
+    t = MultiThread(lambda n, thread_id, worker: worker, n_workers=2, initializer=connect, pass_worker=True)
+    with pytest.raises(RunCancelledError, match='initializer failed') as e:
+        t.run_with_iter(range(100))
+    assert any(isinstance(f.exception, ConnectionError) for f in e.value.failures)
+    # the failed workers are replaced, retrying the initializer
+    assert t.run_with_iter(range(10)) == ['connection'] * 10
+    assert len(attempts) == 4
+
+
+def test_failing_process_initializer():
+    def connect():
+        raise ConnectionError('no database')
+
+    with pytest.raises(WorkerDiedError):
+        multiprocessed(2, initializer=connect)(lambda n, thread_id: n)(range(10))
@@ -0,0 +1,108 @@
+from lump.profiling import timeit, tracer, install_profiler_toggle, install_memory_signals, SamplingProfiler
+import pytest
+from lump.multithreading import multithreaded
+import json
+import os
+import signal
+import threading
+import time
+import tracemalloc
+
+
+def test_timeit_trace_across_workers(tmp_path):
+    @multithreaded(2)
+    def work(n, thread_id):
+        with timeit('item'):
+            return n
+
+    tracer.enable()
+    try:
+        with timeit('run'):
+            work(range(4))
+    finally:
+        tracer.disable()
+
+    trace = tracer.traces[-1]
+    tracer.clear()
+    assert trace.name == 'run'
+    assert [child.name for child in trace.children] == ['item'] * 4
+
+    tracer.traces.append(trace)
+    tracer.export(str(tmp_path / 'trace.json'))
+    tracer.export(str(tmp_path / 'speedscope.json'), format='speedscope')
+    tracer.clear()
+
+    with open(str(tmp_path / 'trace.json')) as f:
+        assert len(json.load(f)['traceEvents']) == 5
+    with open(str(tmp_path / 'speedscope.json')) as f:
+        speedscope = json.load(f)
+    assert sum(len(profile['events']) for profile in speedscope['profiles']) == 10
+
+
+def test_timeit_trace_sampling():
+    tracer.enable(sample_rate=0)
+    try:
+        with timeit('run'):
+            with timeit('nested'):
+                pass
+    finally:
+        tracer.disable()
+        tracer.sample_rate = 1
+    assert len(tracer.traces) == 0
+
+
+def test_profiler_toggle(tmp_path):
+    path = str(tmp_path / 'profile-%d.collapsed')
+    signum = install_profiler_toggle(path=path, interval=.001)
+    try:
+        os.kill(os.getpid(), signum)
+        end = time.monotonic() + .05
+        while time.monotonic() < end:
+            pass
+        os.kill(os.getpid(), signum)
+    finally:
+        signal.signal(signum, signal.SIG_DFL)
+
+    with open(path % (os.getpid(),)) as f:
+        assert 'test_profiler_toggle' in f.read()
+
+
+def test_sample_in_signal_handler():
+    profiler = SamplingProfiler(use_signal=True)
+    # a signal may interrupt the main thread while it holds the lock of threading.enumerate
+    with threading._active_limbo_lock:
+        profiler.sample(in_signal_handler=True)
+    assert profiler.samples == 1
+    assert any(stack.startswith('MainThread;') for stack in profiler.stacks)
+
+
+def test_memory_signals(tmp_path):
+    path = str(tmp_path / 'mem-%d.txt')
+    snapshot_signum, diff_signum = install_memory_signals(path=path)
+    try:
+        os.kill(os.getpid(), snapshot_signum)
+        leak = [Leak() for _ in range(100)]
+        os.kill(os.getpid(), diff_signum)
+    finally:
+        signal.signal(snapshot_signum, signal.SIG_DFL)
+        signal.signal(diff_signum, signal.SIG_DFL)
+        tracemalloc.stop()
+
+    with open(path % (os.getpid(),)) as f:
+        report = f.read()
+    assert 'Top 10 allocation sites by growth' in report
+    assert 'Leak' in report
+    assert len(leak) == 100
+
+
+class Leak:
+    pass
+
+
+def test_no_realtime_signals(monkeypatch):
+    monkeypatch.delattr(signal, 'SIGRTMIN', raising=False)
+    # no fallback to e.g. SIGUSR2, which makes gunicorn's master re-execute itself
+    with pytest.raises(ValueError):
+        install_profiler_toggle()
+    with pytest.raises(ValueError):
+        install_memory_signals()